@@ -3,19 +3,75 @@ Exati routers and session authenticator.
 '''
 
 import os
-from base64 import b64encode
-from time import sleep
+import csv
+import json
+import math
+import random
+import socket
+import sqlite3
+import asyncio
+import codecs
+import hashlib
+import threading
+from array import array
+from base64 import b64encode, urlsafe_b64decode
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import Counter, OrderedDict, deque
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from time import sleep, monotonic, time
 from datetime import datetime, timedelta
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field, fields as dataclass_fields
 
 import requests
+from urllib3.connection import HTTPConnection
 from dotenv import load_dotenv
 
 load_dotenv()
 
+CACHE_DIR = os.environ.get('EXATI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'exati'))
 
-@dataclass
-class Ocorrencia:
+# monotonic() instant when the current batch must stop. Copied to worker threads by the executors of this module.
+DEADLINE: ContextVar[float] = ContextVar('exati_deadline', default=None)
+
+
+class Registro():
+    '''
+    Base of the data classes with records from Exati.
+    Subclasses are slotted dataclasses, so header and data read attributes without copying them.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_record(cls, record: dict) -> 'Registro':
+        '''
+        Builds the data class from an API record. Keys that are not fields are ignored.
+        '''
+        return cls(**{item.name: record[item.name] for item in dataclass_fields(cls) if item.name in record})
+
+    def header(self) -> list:
+        '''
+        Cabeçalho
+        '''
+        return [item.name for item in dataclass_fields(self)]
+
+    def data(self) -> list:
+        '''
+        Conteudo da data class
+        '''
+        return [getattr(self, item.name) for item in dataclass_fields(self)]
+
+    def to_dict(self) -> dict:
+        '''
+        Shallow dict of the data class.
+        '''
+        return {item.name: getattr(self, item.name) for item in dataclass_fields(self)}
+
+
+@dataclass(slots=True)
+class Ocorrencia(Registro):
     '''
     Representa uma Ocorrência do sistema da Exati.
     '''
@@ -33,24 +89,14 @@ class Ocorrencia:
     DATA_RECLAMACAO: str = None
     HORA_RECLAMACAO: str = None
     OBS: str = None
+    DESC_STATUS_ATENDIMENTO_REABERTO: str = None
+    DESC_MOTIVO_REABERTURA: str = None
     RESULTADO: str = None
     MENSAGEM: str = None
 
-    def header(self) -> list:
-        '''
-        Cabeçalho
-        '''
-        return asdict(self).keys()
-
-    def data(self) -> list:
-        '''
-        Conteudo da data class
-        '''
-        return asdict(self).values()
-
 
-@dataclass
-class Laudo:
+@dataclass(slots=True)
+class Laudo(Registro):
     '''
     Informações de Laudo da Avaliação Técnica
     '''
@@ -69,59 +115,1661 @@ class Laudo:
     MENSAGEM: str = None
 
 
-@dataclass
-class PontoServico:
-    '''
-    Representa um Ponto de Serviço da Exati.
-    '''
-    ID_PONTO_SERVICO: int = None
-    LATITUDE_TOTAL: float = None
-    LONGITUDE_TOTAL: float = None
+@dataclass(slots=True)
+class PontoServico(Registro):
+    '''
+    Representa um Ponto de Serviço da Exati.
+    '''
+    ID_PONTO_SERVICO: int = None
+    LATITUDE_TOTAL: float = None
+    LONGITUDE_TOTAL: float = None
+
+
+def write_csv(registros: Iterable[Registro], file, delimiter: str = ';'):
+    '''
+    Writes registros to an open text file as CSV, one row at a time.
+    The header comes from the first registro.
+    '''
+    writer = None
+    for registro in registros:
+        if writer is None:
+            writer = csv.writer(file, delimiter=delimiter)
+            writer.writerow(registro.header())
+        writer.writerow(registro.data())
+
+
+def write_ndjson(registros: Iterable[Registro], file):
+    '''
+    Writes registros to an open text file as NDJSON, one line per registro.
+    '''
+    def default(value):
+        return value.to_dict() if isinstance(value, Registro) else str(value)
+    for registro in registros:
+        file.write(json.dumps(registro.to_dict(), ensure_ascii=False, default=default))
+        file.write('\n')
+
+
+class PontosServico():
+    '''
+    Columnar store of PontoServico, backed by arrays, with a grid index for spatial queries.
+    cell_size -> grid cell size in degrees (0.005 is about 500 m).
+    Distances are in meters.
+    '''
+    EARTH_RADIUS = 6371008.8
+    METERS_PER_DEGREE = 111195.0
+
+    def __init__(self, cell_size: float = 0.005):
+        self.cell_size = cell_size
+        self.ids = array('q')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.__rows: dict[int, int] = {}
+        self.__grid: dict[tuple[int, int], array] = {}
+        self.__bounds: list[int] = None
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict], cell_size: float = 0.005) -> 'PontosServico':
+        '''
+        Builds the store from IDsParqueServico records. Records without coordinates are skipped.
+        '''
+        pontos = cls(cell_size=cell_size)
+        for record in records:
+            try:
+                latitude = float(str(record['LATITUDE_TOTAL']).replace(',', '.'))
+                longitude = float(str(record['LONGITUDE_TOTAL']).replace(',', '.'))
+            except (KeyError, ValueError):
+                continue
+            pontos.append(int(record['ID_PONTO_SERVICO']), latitude, longitude)
+        return pontos
+
+    def append(self, ps: int, latitude: float, longitude: float):
+        '''
+        Adds a ponto de serviço.
+        '''
+        row = len(self.ids)
+        self.ids.append(ps)
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.__rows[ps] = row
+        x, y = self.cell(latitude, longitude)
+        self.__grid.setdefault((x, y), array('l')).append(row)
+        if self.__bounds is None:
+            self.__bounds = [x, y, x, y]
+        else:
+            self.__bounds = [min(self.__bounds[0], x), min(self.__bounds[1], y), max(self.__bounds[2], x), max(self.__bounds[3], y)]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[PontoServico]:
+        return (PontoServico(*row) for row in zip(self.ids, self.latitudes, self.longitudes))
+
+    def __getitem__(self, ps: int) -> PontoServico:
+        row = self.__rows[ps]
+        return PontoServico(self.ids[row], self.latitudes[row], self.longitudes[row])
+
+    def cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        '''
+        Grid cell of a coordinate.
+        '''
+        return math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size)
+
+    def distance(self, latitude_a: float, longitude_a: float, latitude_b: float, longitude_b: float) -> float:
+        '''
+        Haversine distance in meters.
+        '''
+        phi_a, phi_b = math.radians(latitude_a), math.radians(latitude_b)
+        d_phi = phi_b - phi_a
+        d_lambda = math.radians(longitude_b - longitude_a)
+        h = math.sin(d_phi / 2) ** 2 + math.cos(phi_a) * math.cos(phi_b) * math.sin(d_lambda / 2) ** 2
+        return 2 * self.EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+    def bbox(self, min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float) -> list[int]:
+        '''
+        IDs of pontos inside a bounding box.
+        '''
+        min_x, min_y = self.cell(min_latitude, min_longitude)
+        max_x, max_y = self.cell(max_latitude, max_longitude)
+        return [
+            self.ids[row]
+            for x in range(min_x, max_x + 1)
+            for y in range(min_y, max_y + 1)
+            for row in self.__grid.get((x, y), ())
+            if min_latitude <= self.latitudes[row] <= max_latitude and min_longitude <= self.longitudes[row] <= max_longitude
+        ]
+
+    def radius(self, latitude: float, longitude: float, meters: float) -> list[tuple[int, float]]:
+        '''
+        (ID, distance) of pontos within meters of a coordinate, nearest first.
+        '''
+        d_latitude = meters / self.METERS_PER_DEGREE
+        d_longitude = d_latitude / max(math.cos(math.radians(latitude)), 1e-6)
+        found = []
+        for ps in self.bbox(latitude - d_latitude, longitude - d_longitude, latitude + d_latitude, longitude + d_longitude):
+            row = self.__rows[ps]
+            distance = self.distance(latitude, longitude, self.latitudes[row], self.longitudes[row])
+            if distance <= meters:
+                found.append((ps, distance))
+        return sorted(found, key=lambda item: item[1])
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1) -> list[tuple[int, float]]:
+        '''
+        (ID, distance) of the k nearest pontos, nearest first.
+        Searches rings of grid cells around the coordinate until no closer ponto can exist.
+        Rings start at the first one touching the grid bounds and only their border cells inside the bounds are read.
+        '''
+        if not self.__grid:
+            return []
+        center_x, center_y = self.cell(latitude, longitude)
+        min_x, min_y, max_x, max_y = self.__bounds
+        first_ring = max(0, min_x - center_x, center_x - max_x, min_y - center_y, center_y - max_y)
+        max_ring = max(center_x - min_x, max_x - center_x, center_y - min_y, max_y - center_y)
+        # Longitude degrees are shortest at the latitude farthest from the equator among the query and the pontos.
+        extreme = min(90.0, max(abs(latitude), abs(min_x * self.cell_size), abs((max_x + 1) * self.cell_size)))
+        ring_meters = self.cell_size * self.METERS_PER_DEGREE * max(math.cos(math.radians(extreme)), 1e-6)
+        found = []
+        for ring in range(first_ring, max_ring + 1):
+            for x, y in self.__ring_cells(center_x, center_y, ring):
+                for row in self.__grid.get((x, y), ()):
+                    found.append((self.ids[row], self.distance(latitude, longitude, self.latitudes[row], self.longitudes[row])))
+            if len(found) >= k:
+                found.sort(key=lambda item: item[1])
+                if found[k - 1][1] <= ring * ring_meters:
+                    break
+        found.sort(key=lambda item: item[1])
+        return found[:k]
+
+    def __ring_cells(self, center_x: int, center_y: int, ring: int) -> Iterator[tuple[int, int]]:
+        '''
+        Border cells of ring around the center, clamped to the grid bounds.
+        '''
+        min_x, min_y, max_x, max_y = self.__bounds
+        low_y, high_y = max(min_y, center_y - ring), min(max_y, center_y + ring)
+        for x in (center_x - ring, center_x + ring) if ring else (center_x,):
+            if min_x <= x <= max_x:
+                for y in range(low_y, high_y + 1):
+                    yield x, y
+        for y in (center_y - ring, center_y + ring) if ring else (center_y,):
+            if min_y <= y <= max_y:
+                for x in range(max(min_x, center_x - ring + 1), min(max_x, center_x + ring - 1) + 1):
+                    yield x, y
+
+    def groups(self) -> dict[tuple[int, int], list[int]]:
+        '''
+        IDs of pontos grouped by grid cell.
+        '''
+        return {cell: [self.ids[row] for row in rows] for cell, rows in self.__grid.items()}
+
+
+class ExatiError(Exception):
+    '''
+    Exati answered with ERRORS where records were expected.
+    errors -> ERRORS messages of the response.
+    '''
+    def __init__(self, errors: list):
+        super().__init__('; '.join(map(str, errors)))
+        self.errors = errors
+
+
+@dataclass
+class RetryPolicy:
+    '''
+    Retry rules for ExatiSession.ex_post.
+    Delays grow exponentially from base_delay up to max_delay and use full jitter,
+    so concurrent clients don't retry in sync.
+    max_attempts -> total number of requests per command, including the first one.
+    max_elapsed -> time budget in seconds for a command, including delays.
+    non_retryable -> pieces of Exati ERRORS messages that won't change by retrying.
+    '''
+    max_attempts: int = 4
+    base_delay: float = 0.25
+    max_delay: float = 8.0
+    multiplier: float = 2.0
+    max_elapsed: float = 60.0
+    non_retryable: tuple[str, ...] = field(default=(
+        'Necessário',
+        'inválid',
+        'Inválid',
+        'não encontrad',
+        'Não encontrad',
+        'já existe',
+        'permissão',
+    ))
+    auth_errors: tuple[str, ...] = field(default=(
+        'HTTP 401',
+        'HTTP 403',
+        'Token',
+        'token',
+        'Sessão expirada',
+        'sessão expirada',
+        'não autenticado',
+        'Não autenticado',
+    ))
+    retryable_exceptions: tuple[type, ...] = field(default=(
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.JSONDecodeError,
+    ))
+
+    def is_retryable(self, errors: list[str]) -> bool:
+        '''
+        Returns False when any message in errors matches non_retryable.
+        '''
+        return not any(pattern in str(error) for error in errors for pattern in self.non_retryable)
+
+    def is_auth_error(self, errors: list[str]) -> bool:
+        '''
+        Returns True when any message in errors means the JWT was rejected.
+        '''
+        return any(pattern in str(error) for error in errors for pattern in self.auth_errors)
+
+    def delay(self, attempt: int) -> float:
+        '''
+        Seconds to wait after a failed attempt (1 = first attempt).
+        '''
+        return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1)))
+
+    def should_retry(self, attempt: int, start: float, deadline_at: float = None) -> bool:
+        '''
+        Checks attempts, time budget and deadline_at (monotonic instant).
+        '''
+        return attempt < self.max_attempts and monotonic() - start < self.max_elapsed and (deadline_at is None or monotonic() < deadline_at)
+
+
+@contextmanager
+def deadline(seconds: float):
+    '''
+    Every ex_post inside the block, retries and worker threads included, must finish in seconds.
+    Nested blocks keep the earliest deadline.
+        with deadline(30):
+            AtendimentoPorPontoServico(session).batch_status_motivo_date(ids_ps)
+    '''
+    current = DEADLINE.get()
+    token = DEADLINE.set(monotonic() + seconds if current is None else min(current, monotonic() + seconds))
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+class TokenCache():
+    '''
+    Persists Exati JWTs in a SQLite file, keyed by user and URL.
+    SQLite locking makes it safe to share between processes.
+    Tokens are valid until the exp claim of the JWT (minus margin seconds) or,
+    when the JWT has no exp, until ttl seconds after being stored.
+    The file is created with mode 0600 and a missing directory with 0700.
+    '''
+    def __init__(self, path: str = None, ttl: float = 3600, margin: float = 60):
+        self.path = os.path.join(CACHE_DIR, 'tokens.sqlite') if path is None else path
+        self.ttl = ttl
+        self.margin = margin
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory, mode=0o700)
+        except FileExistsError:
+            # Another process may create it at the same time, only the creator sets its mode.
+            pass
+        else:
+            os.chmod(directory, 0o700)
+        # Tokens are credentials: the file is only readable by its owner.
+        os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+        os.chmod(self.path, 0o600)
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, token TEXT, expires REAL)')
+
+    def __connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(user: str, url: str) -> str:
+        '''
+        Cache key for user and url. Passwords are never stored.
+        '''
+        return hashlib.sha256(f'{user}@{url}'.encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        '''
+        Returns a still valid token or None.
+        '''
+        with self.__connect() as connection:
+            row = connection.execute('SELECT token FROM tokens WHERE key = ? AND expires > ?', (key, time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key: str, token: str):
+        '''
+        Stores a token.
+        '''
+        expires = self.expiration(token)
+        expires = time() + self.ttl if expires is None else expires - self.margin
+        with self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', (key, token, expires))
+
+    def invalidate(self, key: str, token: str = None):
+        '''
+        Removes the token for key. With token, only removes it if it is still the stored one,
+        so a process doesn't drop a token another process just refreshed.
+        '''
+        with self.__connect() as connection:
+            if token is None:
+                connection.execute('DELETE FROM tokens WHERE key = ?', (key,))
+            else:
+                connection.execute('DELETE FROM tokens WHERE key = ? AND token = ?', (key, token))
+
+    @staticmethod
+    def expiration(token: str) -> float:
+        '''
+        Reads the exp claim of a JWT, without validating it. Returns None if not available.
+        '''
+        try:
+            claims = token.removeprefix('Bearer ').split('.')[1]
+            return float(json.loads(urlsafe_b64decode(claims + '=' * (- len(claims) % 4)))['exp'])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return None
+
+
+class Cassette():
+    '''
+    On-disk store of ex_post payloads and responses, in a SQLite file.
+    mode = 'record' -> ExatiSession saves every response, in order.
+    mode = 'replay' -> ExatiSession answers from the cassette, without network or Login.
+    Identical payloads are replayed in the order they were recorded, repeating the last one.
+    Login is never recorded.
+    '''
+    def __init__(self, path: str, mode: str = 'replay'):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'mode must be record or replay, not {mode}')
+        self.path = path
+        self.mode = mode
+        self.__played: dict[str, int] = {}
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.__connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS interactions (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, command TEXT, payload TEXT, response TEXT)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS interactions_key ON interactions (key)')
+
+    def __connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @property
+    def replaying(self) -> bool:
+        '''
+        True in replay mode.
+        '''
+        return self.mode == 'replay'
+
+    def record(self, payload: dict, response: dict):
+        '''
+        Appends an interaction.
+        '''
+        if payload.get('CMD_COMMAND') == 'Login':
+            return
+        with self.__connect() as connection:
+            connection.execute(
+                'INSERT INTO interactions (key, command, payload, response) VALUES (?, ?, ?, ?)',
+                (ResponseCache.key(payload), payload.get('CMD_COMMAND'), json.dumps(payload, default=str), json.dumps(response))
+            )
+
+    def play(self, payload: dict) -> dict:
+        '''
+        Next recorded response for payload. Raises KeyError if it was never recorded.
+        '''
+        key = ResponseCache.key(payload)
+        with self.__lock:
+            index = self.__played.get(key, 0)
+            self.__played[key] = index + 1
+        with self.__connect() as connection:
+            rows = connection.execute('SELECT response FROM interactions WHERE key = ? ORDER BY id', (key,)).fetchall()
+        if not rows:
+            raise KeyError(f'{payload.get("CMD_COMMAND")} not in cassette {self.path}: {payload}')
+        return json.loads(rows[min(index, len(rows) - 1)][0])
+
+
+class SingleFlight():
+    '''
+    Coalesces identical read-only ex_post payloads: while a request is in flight, other threads
+    asking for the same payload wait for it and get the same parsed response.
+    reuse_window -> seconds a finished response keeps being reused. 0 only shares in-flight requests.
+    read_only -> CMD_COMMAND prefixes that are safe to coalesce. Other commands are never coalesced.
+    '''
+    def __init__(self, reuse_window: float = 0.0, read_only: tuple[str, ...] = ('Consultar',)):
+        self.reuse_window = reuse_window
+        self.read_only = read_only
+        self.__lock = threading.Lock()
+        self.__flights: dict[str, dict] = {}
+        self.__done: dict[str, tuple[float, dict]] = {}
+
+    def is_read_only(self, payload: dict) -> bool:
+        '''
+        True when payload can be coalesced.
+        '''
+        return str(payload.get('CMD_COMMAND', '')).startswith(self.read_only)
+
+    def do(self, payload: dict, func: Callable[[], dict]) -> dict:
+        '''
+        Returns func() for payload, sharing it with concurrent calls for the same payload.
+        '''
+        key = ResponseCache.key(payload)
+        with self.__lock:
+            done = self.__done.get(key)
+            if done is not None and done[0] > monotonic():
+                return done[1]
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': threading.Event(), 'response': None, 'error': None}
+                self.__flights[key] = flight
+        if not leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['response']
+        try:
+            flight['response'] = func()
+            return flight['response']
+        except BaseException as error:
+            flight['error'] = error
+            raise
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+                if self.reuse_window and flight['error'] is None:
+                    now = monotonic()
+                    if len(self.__done) > 256:
+                        self.__done = {item: done for item, done in self.__done.items() if done[0] > now}
+                    self.__done[key] = (now + self.reuse_window, flight['response'])
+            flight['event'].set()
+
+
+class Hedging():
+    '''
+    Hedged reads: when a read-only request takes longer than the quantile of the recent latencies
+    of its command, a duplicate is sent and the first answer wins. The slower one is discarded.
+    min_samples -> latencies needed before hedging a command. Until then, min_delay is used only when min_samples is 0.
+    read_only -> CMD_COMMAND prefixes that are idempotent. Other commands are never duplicated.
+    hedges -> number of duplicates sent.
+    '''
+    def __init__(self, quantile: float = 0.95, min_samples: int = 20, min_delay: float = 0.05, window: int = 200,
+                 read_only: tuple[str, ...] = ('Consultar',), max_workers: int = 8):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self.read_only = read_only
+        self.hedges = 0
+        self.__latencies: dict[str, deque] = {}
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='exati')
+
+    def is_read_only(self, payload: dict) -> bool:
+        '''
+        True when payload can be sent twice.
+        '''
+        return str(payload.get('CMD_COMMAND', '')).startswith(self.read_only)
+
+    def threshold(self, command: str) -> float:
+        '''
+        Seconds to wait before the duplicate of command, or None while there are not enough samples.
+        '''
+        with self.__lock:
+            latencies = sorted(self.__latencies.get(command, ()))
+        if len(latencies) < max(1, self.min_samples):
+            return self.min_delay if self.min_samples == 0 else None
+        return max(self.min_delay, latencies[min(len(latencies) - 1, int(len(latencies) * self.quantile))])
+
+    def observe(self, command: str, seconds: float):
+        '''
+        Adds the latency of an answered request.
+        '''
+        with self.__lock:
+            self.__latencies.setdefault(command, deque(maxlen=self.window)).append(seconds)
+
+    def send(self, command: str, func: Callable[[], requests.Response]) -> requests.Response:
+        '''
+        Returns func(), calling it again in parallel when the first call is slower than threshold(command).
+        A failure only wins when there is no other request left.
+        '''
+        threshold = self.threshold(command)
+        if threshold is None:
+            return self.__timed(command, func)
+        pending = {self.__executor.submit(copy_context().run, self.__timed, command, func)}
+        done, pending = wait(pending, timeout=threshold)
+        if not done:
+            with self.__lock:
+                self.hedges += 1
+            pending.add(self.__executor.submit(copy_context().run, self.__timed, command, func))
+        while True:
+            if not done:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future = done.pop()
+            if future.exception() is None or not (done or pending):
+                return future.result()
+
+    def close(self):
+        '''
+        Stops the threads of the duplicates.
+        '''
+        self.__executor.shutdown(wait=False)
+
+    def __timed(self, command: str, func: Callable[[], requests.Response]) -> requests.Response:
+        start = monotonic()
+        response = func()
+        self.observe(command, monotonic() - start)
+        return response
+
+
+class RateLimiter():
+    '''
+    Token bucket for ex_post, shared by threads and, with path, by local processes through a SQLite file.
+    rate -> initial requests per second. burst -> bucket size.
+    costs -> tokens per CMD_COMMAND, default 1. Costs can't be larger than burst.
+    The rate adapts to the server: it is multiplied by decrease when more than error_threshold of the
+    recent requests failed, and grows by increase requests per second on each success, within min_rate and max_rate.
+    '''
+    def __init__(self, rate: float = 10.0, burst: float = 20.0, costs: dict[str, float] = None, path: str = None,
+                 min_rate: float = 0.5, max_rate: float = None, increase: float = 0.05, decrease: float = 0.7,
+                 error_threshold: float = 0.2, window: int = 50):
+        self.burst = burst
+        self.costs = {} if costs is None else costs
+        too_expensive = {command: cost for command, cost in self.costs.items() if cost > burst}
+        if too_expensive or burst < 1:
+            raise ValueError(f'costs {too_expensive or 1} larger than burst {burst}, acquire would never return')
+        self.path = path
+        self.min_rate = min_rate
+        self.max_rate = rate * 4 if max_rate is None else max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.error_threshold = error_threshold
+        self.__outcomes: list[bool] = []
+        self.__window = window
+        self.__factor = 1.0
+        self.__lock = threading.Lock()
+        self.__bucket_lock = threading.Lock()
+        self.__state = {'tokens': burst, 'updated': time(), 'rate': rate}
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with self.__connect() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY CHECK (id = 0), tokens REAL, updated REAL, rate REAL)')
+                connection.execute('INSERT OR IGNORE INTO bucket VALUES (0, ?, ?, ?)', (burst, time(), rate))
+
+    def __connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @property
+    def rate(self) -> float:
+        '''
+        Current requests per second.
+        '''
+        return self.__transaction(lambda state: self.__take(state, 0))[1]['rate']
+
+    def acquire(self, command: str = None):
+        '''
+        Blocks until the bucket has the tokens of command.
+        Raises requests.exceptions.Timeout when the wait would pass the deadline of the block.
+        '''
+        cost = self.costs.get(command, 1.0)
+        while True:
+            seconds, _ = self.__transaction(lambda state: self.__take(state, cost))
+            if seconds <= 0:
+                return
+            deadline_at = DEADLINE.get()
+            if deadline_at is not None and monotonic() + seconds > deadline_at:
+                raise requests.exceptions.Timeout(f'Deadline exceeded waiting for the rate limit of {command}')
+            sleep(seconds)
+
+    def feedback(self, ok: bool):
+        '''
+        Adds the outcome of a request. Failed requests push the rate down, successes raise it slowly.
+        '''
+        with self.__lock:
+            self.__outcomes.append(ok)
+            if len(self.__outcomes) > self.__window:
+                del self.__outcomes[0]
+            errors = self.__outcomes.count(False)
+            if not ok and errors >= max(2, self.error_threshold * len(self.__outcomes)):
+                self.__factor *= self.decrease
+                self.__outcomes.clear()
+            elif ok:
+                self.__factor += self.increase / max(self.__state['rate'], self.min_rate)
+
+    def __take(self, state: dict, cost: float) -> float:
+        '''
+        Refills state and takes cost tokens. Returns seconds to wait when there are not enough tokens.
+        '''
+        now = time()
+        with self.__lock:
+            factor, self.__factor = self.__factor, 1.0
+        state['rate'] = min(self.max_rate, max(self.min_rate, state['rate'] * factor))
+        state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+        state['updated'] = now
+        if state['tokens'] >= cost:
+            state['tokens'] -= cost
+            return 0
+        return (cost - state['tokens']) / state['rate']
+
+    def __transaction(self, func: Callable[[dict], float]) -> tuple[float, dict]:
+        '''
+        Runs func over the bucket state, in memory or in an exclusive SQLite transaction.
+        '''
+        if self.path is None:
+            with self.__bucket_lock:
+                return func(self.__state), dict(self.__state)
+        connection = self.__connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            tokens, updated, rate = connection.execute('SELECT tokens, updated, rate FROM bucket WHERE id = 0').fetchone()
+            state = {'tokens': tokens, 'updated': updated, 'rate': rate}
+            result = func(state)
+            connection.execute('UPDATE bucket SET tokens = ?, updated = ?, rate = ? WHERE id = 0', (state['tokens'], state['updated'], state['rate']))
+            connection.execute('COMMIT')
+            self.__state = state
+            return result, state
+        finally:
+            connection.close()
+
+
+@dataclass
+class ExPostCall:
+    '''
+    One ExatiSession.ex_post call, given to request start and end hooks.
+    error -> exception name, ERRORS when Exati answered with errors or RAIZ when the response had no RAIZ.
+    timeout -> seconds per attempt. deadline -> monotonic() instant shared by all attempts, or None.
+    '''
+    payload: dict
+    command: str
+    start: float
+    timeout: float = None
+    deadline: float = None
+    seconds: float = None
+    attempts: int = 0
+    size: int = 0
+    error: str = None
+    response: dict = None
+
+
+class Metrics():
+    '''
+    ex_post metrics by CMD_COMMAND: calls, latency histogram, attempts, errors and response bytes.
+    record is a request end hook. Exports to Prometheus text format or a JSON snapshot.
+    '''
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets: tuple[float, ...] = None):
+        self.buckets = self.BUCKETS if buckets is None else tuple(sorted(buckets))
+        self.__commands: dict[str, dict] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, call: ExPostCall):
+        '''
+        Adds a finished call.
+        '''
+        with self.__lock:
+            metrics = self.__commands.setdefault(call.command, {
+                'calls': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(self.buckets),
+                'attempts': 0,
+                'max_attempts': 0,
+                'bytes': 0,
+                'errors': {},
+            })
+            metrics['calls'] += 1
+            metrics['seconds'] += call.seconds
+            for index, bucket in enumerate(self.buckets):
+                if call.seconds <= bucket:
+                    metrics['buckets'][index] += 1
+            metrics['attempts'] += call.attempts
+            metrics['max_attempts'] = max(metrics['max_attempts'], call.attempts)
+            metrics['bytes'] += call.size
+            if call.error is not None:
+                metrics['errors'][call.error] = metrics['errors'].get(call.error, 0) + 1
+
+    def snapshot(self) -> dict:
+        '''
+        Copy of the metrics, keyed by CMD_COMMAND. Buckets are cumulative, as in Prometheus.
+        '''
+        with self.__lock:
+            return {
+                command: {**metrics, 'buckets': dict(zip(map(str, self.buckets), metrics['buckets'])), 'errors': dict(metrics['errors'])}
+                for command, metrics in self.__commands.items()
+            }
+
+    def write_json(self, path: str):
+        '''
+        Writes a JSON snapshot to path, replacing it atomically.
+        '''
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({'time': time(), 'commands': self.snapshot()}, file, ensure_ascii=False, indent=2)
+        os.replace(temporary, path)
+
+    def to_prometheus(self) -> str:
+        '''
+        Metrics in Prometheus text format.
+        '''
+        def histogram(label: str, metrics: dict) -> list[str]:
+            buckets = [f'exati_request_seconds_bucket{{{label},le="{bucket}"}} {count}' for bucket, count in metrics['buckets'].items()]
+            return buckets + [
+                f'exati_request_seconds_bucket{{{label},le="+Inf"}} {metrics["calls"]}',
+                f'exati_request_seconds_sum{{{label}}} {metrics["seconds"]}',
+                f'exati_request_seconds_count{{{label}}} {metrics["calls"]}',
+            ]
+
+        # Every family is one group: its TYPE line, then its samples for all commands.
+        families = [
+            ('exati_requests_total', 'counter', lambda label, metrics: [f'exati_requests_total{{{label}}} {metrics["calls"]}']),
+            ('exati_request_seconds', 'histogram', histogram),
+            ('exati_request_attempts_total', 'counter', lambda label, metrics: [f'exati_request_attempts_total{{{label}}} {metrics["attempts"]}']),
+            ('exati_request_max_attempts', 'gauge', lambda label, metrics: [f'exati_request_max_attempts{{{label}}} {metrics["max_attempts"]}']),
+            ('exati_response_bytes_total', 'counter', lambda label, metrics: [f'exati_response_bytes_total{{{label}}} {metrics["bytes"]}']),
+            ('exati_request_errors_total', 'counter', lambda label, metrics: [
+                f'exati_request_errors_total{{{label},error="{error}"}} {count}' for error, count in sorted(metrics['errors'].items())]),
+        ]
+        commands = sorted(self.snapshot().items(), key=lambda item: str(item[0]))
+        lines = []
+        for name, kind, samples in families:
+            lines.append(f'# TYPE {name} {kind}')
+            for command, metrics in commands:
+                lines.extend(samples(f'command="{command}"', metrics))
+        return '\n'.join(lines) + '\n'
+
+
+class ExatiSession(requests.sessions.Session):
+    '''
+    Manage authentication, sessions and a new post request, dealing with Exati responses.
+    token_cache -> optional TokenCache, reused between processes to skip the Login request.
+    metrics -> Metrics of every ex_post. on_request_start and on_request_end -> lists of
+    callables receiving an ExPostCall before and after each ex_post.
+    cassette -> optional Cassette, to record responses or replay them without network.
+    single_flight -> optional SingleFlight, shares one request among identical concurrent read-only payloads.
+    rate_limiter -> optional RateLimiter, checked before every request, retries included.
+    timeouts -> seconds per attempt by CMD_COMMAND, over TIMEOUTS. Commands not in timeouts use default_timeout.
+    hedging -> optional Hedging, duplicates slow read-only requests. It may be shared, so it is closed by whoever created it.
+    auth_lock -> lock around re-logins and adapter -> HTTPAdapter mounted before the Login, shared by the sessions of an ExatiSessionPool.
+    The deadline context manager limits every ex_post of a block, in any thread started by this module.
+    '''
+    TIMEOUTS = {
+        'Login': 30,
+        'ConsultarLaudo': 300,
+        'ConsultarPontosServicos': 300,
+        'ConsultarStatusAtendimentoPontoServico': 300,
+    }
+
+    def __init__(self, *args, retry: RetryPolicy = None, token_cache: TokenCache = None, metrics: Metrics = None,
+                 cassette: Cassette = None, single_flight: SingleFlight = None, rate_limiter: RateLimiter = None,
+                 timeouts: dict[str, float] = None, default_timeout: float = 60, hedging: Hedging = None,
+                 auth_lock: threading.Lock = None, adapter: requests.adapters.HTTPAdapter = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if adapter is not None:
+            self.mount('https://', adapter)
+            self.mount('http://', adapter)
+        self.timeouts = {**self.TIMEOUTS, **({} if timeouts is None else timeouts)}
+        self.default_timeout = default_timeout
+        self.hedging = hedging
+        self.retry = RetryPolicy() if retry is None else retry
+        self.token_cache = token_cache
+        self.metrics = Metrics() if metrics is None else metrics
+        self.cassette = cassette
+        self.single_flight = single_flight
+        self.rate_limiter = rate_limiter
+        self.on_request_start: list[Callable[[ExPostCall], None]] = []
+        self.on_request_end: list[Callable[[ExPostCall], None]] = [self.metrics.record]
+        self.__auth_lock = threading.Lock() if auth_lock is None else auth_lock
+        token = None if token_cache is None else token_cache.get(self.token_key)
+        if cassette is not None and cassette.replaying:
+            self.headers['Authorization'] = 'replay'
+        elif token is None:
+            self.auth_exati()
+        else:
+            self.headers['Authorization'] = token
+
+    @property
+    def token_key(self) -> str:
+        '''
+        TokenCache key for the current user and url.
+        '''
+        user = (os.environ.get('EXATI_USER_PASS') or '').split(':')[0]
+        return TokenCache.key(user, os.environ.get('EXATI_URL'))
+
+    def auth_exati(self):
+        '''
+        Returns JWT from authentication response
+        '''
+        basic_auth = f'Basic {b64encode(os.environ.get("EXATI_USER_PASS").encode()).decode()}'
+        payload = {
+            'CMD_PLATAFORM': 'GUIA',
+            'CMD_COMMAND': 'Login',
+            'parser': 'json'
+        }
+        self.headers['Authorization'] = basic_auth
+        response = self.ex_post(payload=payload)
+        jwt = response['RAIZ']['AUTH_TOKEN']
+        self.headers['Authorization'] = jwt
+        if self.token_cache is not None:
+            self.token_cache.set(self.token_key, jwt)
+
+    def reauth_exati(self, rejected_token: str):
+        '''
+        Login again after rejected_token was refused by Exati.
+        Threads that fail with the same token share a single Login.
+        '''
+        with self.__auth_lock:
+            if self.headers.get('Authorization') != rejected_token:
+                return
+            if self.token_cache is not None:
+                self.token_cache.invalidate(self.token_key, rejected_token)
+                token = self.token_cache.get(self.token_key)
+                if token is not None:
+                    self.headers['Authorization'] = token
+                    return
+            self.auth_exati()
+
+    def ex_post(self, payload: dict, warnings=True, retry: RetryPolicy = None, timeout: float = None):
+        '''
+        Modification to post method to handle Exati post requests.
+        Retries following retry (default self.retry). After the last attempt,
+        returns the last response, even with ERRORS, or raises the last network error.
+        When the JWT is rejected, logs in again once and repeats the command.
+        timeout -> seconds per attempt (default from self.timeouts). Raises requests.exceptions.Timeout
+        when the deadline of the block passes before the command succeeds.
+        '''
+        command = payload.get('CMD_COMMAND')
+        call = ExPostCall(payload=payload, command=command, start=monotonic(), deadline=DEADLINE.get(),
+                          timeout=self.timeouts.get(command, self.default_timeout) if timeout is None else timeout)
+        for hook in self.on_request_start:
+            hook(call)
+        try:
+            if self.cassette is not None and self.cassette.replaying:
+                call.response = self.cassette.play(payload)
+                return call.response
+            retry = self.retry if retry is None else retry
+            if self.single_flight is not None and self.single_flight.is_read_only(payload):
+                call.response = self.single_flight.do(payload, partial(self.__ex_post, call, warnings, retry))
+            else:
+                call.response = self.__ex_post(call, warnings, retry)
+            if self.cassette is not None:
+                self.cassette.record(payload, call.response)
+            return call.response
+        except Exception as error:
+            call.error = type(error).__name__
+            raise
+        finally:
+            call.seconds = monotonic() - call.start
+            for hook in self.on_request_end:
+                hook(call)
+
+    def __ex_post(self, call: ExPostCall, warnings: bool, retry: RetryPolicy, read: Callable = None) -> dict:
+        '''
+        Retry loop of ex_post. Keeps attempts, size and error in call.
+        read -> for streamed requests, callable(http_response) returning (result, None) to return result at once,
+        or (None, response) with the whole body parsed, checked as a normal response.
+        '''
+        reauthenticated = call.command == 'Login'
+        while True:
+            call.attempts += 1
+            attempt = call.attempts
+            token = self.headers.get('Authorization')
+            timeout = call.timeout
+            if call.deadline is not None:
+                timeout = min(timeout, call.deadline - monotonic())
+                if timeout <= 0:
+                    raise requests.exceptions.Timeout(f'Deadline exceeded for {call.command}, attempt = {attempt}')
+            try:
+                result, response = self.__attempt(call, timeout, read)
+                if result is not None:
+                    self.__feedback(True)
+                    return result
+            except retry.retryable_exceptions as error:
+                self.__feedback(False)
+                if warnings:
+                    print(f'{error!r}, attempt = {attempt}')
+                if not retry.should_retry(attempt, call.start, call.deadline):
+                    raise
+            else:
+                message = self.__errors(response)
+                if message is None:
+                    self.__feedback(False)
+                    if warnings:
+                        print(f'KeyError de RAIZ, {response}, attempt = {attempt}')
+                    if not retry.should_retry(attempt, call.start, call.deadline):
+                        call.error = 'RAIZ'
+                        return response
+                elif not message:
+                    self.__feedback(True)
+                    return response
+                else:
+                    if warnings:
+                        print(f'{message}, attempt = {attempt}')
+                    if not reauthenticated and retry.is_auth_error(message):
+                        self.reauth_exati(token)
+                        reauthenticated = True
+                        continue
+                    self.__feedback(not retry.is_retryable(message))
+                    if not retry.is_retryable(message) or not retry.should_retry(attempt, call.start, call.deadline):
+                        call.error = 'ERRORS'
+                        return response
+            delay = retry.delay(attempt)
+            sleep(delay if call.deadline is None else max(0, min(delay, call.deadline - monotonic())))
+
+    def __attempt(self, call: ExPostCall, timeout: float, read: Callable = None) -> tuple:
+        '''
+        One request of __ex_post. Returns (result, None) when read finished a stream, otherwise (None, parsed response).
+        Hedged when the command is read only and the request is not streamed.
+        '''
+        send = partial(self.__send, call.command, call.payload, timeout, read is not None)
+        if read is None and self.hedging is not None and self.hedging.is_read_only(call.payload):
+            http_response = self.hedging.send(call.command, send)
+        else:
+            http_response = send()
+        if read is not None and http_response.status_code not in (401, 403):
+            return read(http_response)
+        call.size += len(http_response.content)
+        if http_response.status_code in (401, 403):
+            return None, {'RAIZ': {'MESSAGES': {'ERRORS': [f'HTTP {http_response.status_code}'], 'INFORMATIONS': []}}}
+        return None, http_response.json()
+
+    @staticmethod
+    def __errors(response) -> list:
+        '''
+        ERRORS of a response, or None when it has no RAIZ envelope.
+        '''
+        try:
+            return response['RAIZ']['MESSAGES']['ERRORS']
+        except (KeyError, TypeError):
+            return None
+
+    def __send(self, command: str, payload: dict, timeout: float, stream: bool = False) -> requests.Response:
+        '''
+        One request, after the rate_limiter allows it.
+        '''
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(command)
+        if stream:
+            return self.post(url=os.environ.get('EXATI_URL'), data=payload, timeout=timeout, stream=True)
+        return self.post(url=os.environ.get('EXATI_URL'), data=payload, timeout=timeout)
+
+    def __feedback(self, ok: bool):
+        '''
+        Tells rate_limiter whether the server handled a request.
+        '''
+        if self.rate_limiter is not None:
+            self.rate_limiter.feedback(ok)
+
+    def ex_post_stream(self, payload: dict, key: str, fields: Iterable[str] = None, warnings=True, retry: RetryPolicy = None,
+                       chunk_size: int = 65536) -> Iterator[dict]:
+        '''
+        Streaming ex_post: yields each object of the array key while the body is downloaded in chunks of chunk_size bytes,
+        without keeping the records in memory. fields -> keys to keep in each object, as in iter_json_array.
+        Until key shows up in the body the rules of ex_post apply: rate_limiter, timeouts, retries and re-login.
+        A body without key is checked as a normal response and raises ExatiError when it has ERRORS.
+        Errors after the first record are raised without retrying. Metrics and hooks see the whole stream.
+        With a cassette, replays the recorded body or records the streamed one.
+        '''
+        command = payload.get('CMD_COMMAND')
+        call = ExPostCall(payload=payload, command=command, start=monotonic(), deadline=DEADLINE.get(),
+                          timeout=self.timeouts.get(command, self.default_timeout))
+        for hook in self.on_request_start:
+            hook(call)
+        try:
+            if self.cassette is not None and self.cassette.replaying:
+                replayed = json.dumps(self.cassette.play(payload)).encode()
+                yield from iter_json_array((replayed[start:start + chunk_size] for start in range(0, len(replayed), chunk_size)), key, fields)
+                return
+            retry = self.retry if retry is None else retry
+            result = self.__ex_post(call, warnings, retry, partial(self.__read_head, call, f'"{key}"'.encode(), chunk_size))
+            if isinstance(result, dict):
+                errors = self.__errors(result)
+                if errors is None:
+                    raise ExatiError([f'Resposta sem RAIZ: {result}'])
+                if errors:
+                    raise ExatiError(errors)
+                if self.cassette is not None:
+                    self.cassette.record(payload, result)
+                yield from iter_json_array([json.dumps(result).encode()], key, fields)
+                return
+            head, content, http_response = result
+            chunks = list(head) if self.cassette is not None else None
+
+            def body() -> Iterator[bytes]:
+                yield from head
+                for chunk in content:
+                    call.size += len(chunk)
+                    if chunks is not None:
+                        chunks.append(chunk)
+                    yield chunk
+
+            completed = False
+            try:
+                yield from iter_json_array(body(), key, fields)
+                completed = True
+            except GeneratorExit:
+                # The consumer stopped early, the rest of the body is read below to record it.
+                completed = True
+                raise
+            finally:
+                if chunks is not None and completed:
+                    chunks.extend(content)
+                    self.cassette.record(payload, json.loads(b''.join(chunks)))
+                http_response.close()
+        except Exception as error:
+            call.error = call.error or type(error).__name__
+            raise
+        finally:
+            call.seconds = monotonic() - call.start
+            for hook in self.on_request_end:
+                hook(call)
+
+    @staticmethod
+    def __read_head(call: ExPostCall, marker: bytes, chunk_size: int, http_response: requests.Response) -> tuple:
+        '''
+        Reads a streamed body until marker. Returns ((chunks read, rest of the content, http_response), None)
+        when marker is found, or (None, parsed body) when the body ends without it.
+        '''
+        content = http_response.iter_content(chunk_size=chunk_size)
+        head = []
+        tail = b''
+        for chunk in content:
+            head.append(chunk)
+            call.size += len(chunk)
+            if marker in tail + chunk:
+                return (head, content, http_response), None
+            tail = (tail + chunk)[-len(marker):]
+        http_response.close()
+        try:
+            return None, json.loads(b''.join(head))
+        except json.JSONDecodeError as error:
+            raise requests.exceptions.JSONDecodeError(error.msg, error.doc, error.pos) from error
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    '''
+    HTTPAdapter with TCP keep-alive probes, so idle pooled connections survive NATs and firewalls.
+    idle -> seconds before the first probe, interval -> seconds between probes, count -> failed probes to drop the connection.
+    They are set where the platform has the options, otherwise the system defaults (usually 2 hours idle) apply.
+    '''
+    def __init__(self, *args, idle: int = 60, interval: int = 15, count: int = 4, **kwargs):
+        self.idle = idle
+        self.interval = interval
+        self.count = count
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        # macOS names TCP_KEEPIDLE as TCP_KEEPALIVE.
+        for names, value in ((('TCP_KEEPIDLE', 'TCP_KEEPALIVE'), self.idle), (('TCP_KEEPINTVL',), self.interval), (('TCP_KEEPCNT',), self.count)):
+            name = next((name for name in names if hasattr(socket, name)), None)
+            if name is not None:
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class ExatiSessionPool():
+    '''
+    Hands out ExatiSessions to worker threads. Sessions share one token, one Login and one
+    pool of size keep-alive connections. Default headers are kept, so answers come compressed.
+    token_cache -> optional TokenCache, to also share the token with other processes.
+    Other kwargs are given to every ExatiSession (retry, metrics, rate_limiter...).
+    Usage:
+        with ExatiSessionPool(size=8) as pool:
+            def work(ps):
+                with pool.session() as session:
+                    return AtendimentoPorPontoServico(session=session).get_status_motivo_date(ps)
+            results = list(map_concurrently(work, ids_ps, max_workers=8))
+    '''
+    def __init__(self, size: int = 8, token_cache: TokenCache = None, **kwargs):
+        self.size = size
+        self.token_cache = token_cache
+        self.kwargs = kwargs
+        self.adapter = KeepAliveAdapter(pool_connections=1, pool_maxsize=size)
+        self.__tokens: dict[str, str] = {}
+        self.__lock = threading.Lock()
+        self.__create_lock = threading.Lock()
+        self.__auth_lock = threading.Lock()
+        self.__created: list[ExatiSession] = []
+        self.__idle: list[ExatiSession] = []
+        self.__available = threading.Semaphore(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def session(self) -> Iterator[ExatiSession]:
+        '''
+        Lends a session to the calling thread, blocking while size sessions are in use.
+        '''
+        self.__available.acquire()
+        try:
+            with self.__lock:
+                session = self.__idle.pop() if self.__idle else None
+            if session is None:
+                session = self.__new_session()
+            try:
+                yield session
+            finally:
+                with self.__lock:
+                    self.__idle.append(session)
+        finally:
+            self.__available.release()
+
+    def get(self, key: str) -> str:
+        '''
+        Token shared by the sessions, TokenCache interface.
+        '''
+        with self.__lock:
+            token = self.__tokens.get(key)
+        if token is None and self.token_cache is not None:
+            token = self.token_cache.get(key)
+        return token
+
+    def set(self, key: str, token: str):
+        '''
+        Stores the token after a Login.
+        '''
+        with self.__lock:
+            self.__tokens[key] = token
+        if self.token_cache is not None:
+            self.token_cache.set(key, token)
+
+    def invalidate(self, key: str, token: str = None):
+        '''
+        Drops the token for key, only if it is still token when given.
+        '''
+        with self.__lock:
+            if token is None or self.__tokens.get(key) == token:
+                self.__tokens.pop(key, None)
+        if self.token_cache is not None:
+            self.token_cache.invalidate(key, token)
+
+    def close(self):
+        '''
+        Closes every session and the shared connections.
+        '''
+        with self.__lock:
+            sessions, self.__created, self.__idle = self.__created, [], []
+        for session in sessions:
+            session.close()
+        self.adapter.close()
+
+    def __new_session(self) -> ExatiSession:
+        '''
+        Session over the shared adapter. Sessions are created one at a time, so only the first one logs in.
+        '''
+        with self.__create_lock:
+            session = ExatiSession(token_cache=self, auth_lock=self.__auth_lock, adapter=self.adapter, **self.kwargs)
+        with self.__lock:
+            self.__created.append(session)
+        return session
+
+
+class ResponseCache():
+    '''
+    Caches Exati responses in a SQLite file, with an in-process LRU in front.
+    ttl -> seconds per CMD_COMMAND. Commands not in ttl use default_ttl. None never expires.
+    Only responses without ERRORS are stored.
+    '''
+    def __init__(self, path: str = None, ttl: dict[str, float] = None, default_ttl: float = 86400, max_entries: int = 256):
+        self.path = os.path.join(CACHE_DIR, 'responses.sqlite') if path is None else path
+        self.ttl = {} if ttl is None else ttl
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.__lru: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, command TEXT, expires REAL, response TEXT)')
+
+    def __connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        '''
+        Key from a normalized payload. Same parameters in any order give the same key.
+        '''
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, payload: dict) -> dict:
+        '''
+        Returns a cached response or None when missing or expired.
+        '''
+        key = self.key(payload)
+        with self.__lock:
+            if key in self.__lru:
+                expires, response = self.__lru[key]
+                if expires is None or expires > time():
+                    self.__lru.move_to_end(key)
+                    return response
+                del self.__lru[key]
+        with self.__connect() as connection:
+            row = connection.execute(
+                'SELECT expires, response FROM responses WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time())
+            ).fetchone()
+        if row is None:
+            return None
+        response = json.loads(row[1])
+        self.__remember(key, row[0], response)
+        return response
+
+    def set(self, payload: dict, response: dict):
+        '''
+        Stores a response for payload.
+        '''
+        ttl = self.ttl.get(payload.get('CMD_COMMAND'), self.default_ttl)
+        expires = None if ttl is None else time() + ttl
+        key = self.key(payload)
+        with self.__connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, payload.get('CMD_COMMAND'), expires, json.dumps(response))
+            )
+        self.__remember(key, expires, response)
+
+    def invalidate(self, command: str = None):
+        '''
+        Removes cached responses of command, or every response when command is None.
+        '''
+        with self.__connect() as connection:
+            if command is None:
+                connection.execute('DELETE FROM responses')
+            else:
+                connection.execute('DELETE FROM responses WHERE command = ?', (command,))
+        with self.__lock:
+            self.__lru.clear()
+
+    def fetch(self, session: ExatiSession, payload: dict) -> dict:
+        '''
+        Returns the cached response for payload, requesting it with session.ex_post when missing.
+        '''
+        response = self.get(payload)
+        if response is None:
+            response = session.ex_post(payload=payload)
+            try:
+                if not response['RAIZ']['MESSAGES']['ERRORS']:
+                    self.set(payload, response)
+            except (KeyError, TypeError):
+                pass
+        return response
+
+    def __remember(self, key: str, expires: float, response: dict):
+        with self.__lock:
+            self.__lru[key] = (expires, response)
+            self.__lru.move_to_end(key)
+            while len(self.__lru) > self.max_entries:
+                self.__lru.popitem(last=False)
+
+
+class AsyncExatiSession():
+    '''
+    Asyncio counterpart of ExatiSession.
+    Runs ExatiSession.ex_post in a bounded pool of worker threads, so many Exati commands
+    overlap on the same keep-alive connections. Retry and error semantics are the ones from ExatiSession.
+    max_in_flight -> maximum number of requests running at the same time.
+    Without session, creates one with an adapter of max_in_flight connections and closes it in close.
+    A given session, as the ones of ExatiSessionPool, is used with its own adapters and is left open.
+    '''
+    def __init__(self, session: ExatiSession = None, max_in_flight: int = 10):
+        self.__owns_session = session is None
+        if session is None:
+            session = ExatiSession(adapter=requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight))
+        self.session = session
+        self.max_in_flight = max_in_flight
+        self.__executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='exati')
+        self.__semaphore: asyncio.Semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Shutdown worker threads and close the underlying session, when it was created here.
+        '''
+        self.__executor.shutdown(wait=True)
+        if self.__owns_session:
+            self.session.close()
+
+    async def run(self, func, *args, **kwargs):
+        '''
+        Runs a blocking callable in the worker pool, respecting max_in_flight.
+        '''
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self.__semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.__executor, partial(copy_context().run, func, *args, **kwargs))
+
+    async def ex_post(self, payload: dict, warnings=True) -> dict:
+        '''
+        Async version of ExatiSession.ex_post.
+        '''
+        return await self.run(self.session.ex_post, payload=payload, warnings=warnings)
+
+    async def export(self, router: type, *args, **kwargs):
+        '''
+        Async version of a router export method.
+        A new router instance is created per call, so concurrent exports don't share records.
+        Ex.: await session.export(AtendimentoPorPontoServico, ps=68582)
+        '''
+        return await self.run(router(session=self.session).export, *args, **kwargs)
+
+    async def gather(self, router: type, kwargs_list: list[dict]) -> list:
+        '''
+        Runs router export for each kwargs in kwargs_list concurrently.
+        Results keep the order from kwargs_list.
+        '''
+        return await asyncio.gather(*(self.export(router, **kwargs) for kwargs in kwargs_list))
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str, fields: Iterable[str] = None) -> Iterator[dict]:
+    '''
+    Incrementally parses a JSON body, yielding each object of the array in key
+    as soon as it is decoded. Only the object being decoded is kept in memory.
+    fields -> keys to keep in each object. None keeps every key.
+    Raises KeyError if key is not in the body.
+    '''
+    fields = None if fields is None else frozenset(fields)
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    marker = f'"{key}"'
+    buffer = ''
+    pos = 0
+
+    def read() -> bool:
+        nonlocal buffer, pos
+        chunk = next(chunks, None)
+        buffer = buffer[pos:] + text.decode(b'' if chunk is None else chunk, final=chunk is None)
+        pos = 0
+        return chunk is not None
+
+    while True:
+        found = buffer.find(marker, pos)
+        if found >= 0:
+            pos = found + len(marker)
+            break
+        pos = max(pos, len(buffer) - len(marker))
+        if not read():
+            raise KeyError(key)
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n:,[':
+            pos += 1
+        if pos >= len(buffer):
+            if not read():
+                return
+            continue
+        if buffer[pos] in ']}':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if not read():
+                raise
+            continue
+        pos = end
+        yield record if fields is None else {name: value for name, value in record.items() if name in fields}
+
+
+def map_concurrently(func: Callable, items: Iterable, max_workers: int = 8) -> Iterator[tuple]:
+    '''
+    Runs func(item) for every item in a thread pool.
+    Yields (item, result) as soon as each call finishes. When func raises,
+    result is the exception, so one failure doesn't abort the others.
+    Calls run in a copy of the caller context, so they share its deadline.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='exati') as executor:
+        futures = {executor.submit(copy_context().run, func, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                yield futures[future], error
+
+
+def export_sharded(fetch: Callable[[datetime, datetime], list[dict]], data_inicio: datetime, data_final: datetime, name: str,
+                   slice_days: int = 7, max_workers: int = 4, max_rows: int = None) -> list[dict]:
+    '''
+    Splits [data_inicio, data_final] in slices of slice_days, calls fetch(start, end) for each slice
+    concurrently and merges the records, without repeating records with the same name key.
+    A slice that raises or returns max_rows records or more is split in half and fetched again,
+    down to one day. Records come in date order of their slices.
+    '''
+    slices = []
+    start = data_inicio
+    while start <= data_final:
+        end = min(start + timedelta(days=slice_days - 1), data_final)
+        slices.append((start, end))
+        start = end + timedelta(days=1)
+    done: dict[tuple, list[dict]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='exati') as executor:
+        pending = {executor.submit(copy_context().run, fetch, *window): window for window in slices}
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                start, end = pending.pop(future)
+                try:
+                    records = future.result()
+                    too_many = max_rows is not None and len(records) >= max_rows
+                except Exception:  # pylint: disable=broad-except
+                    if start == end:
+                        raise
+                    records, too_many = None, True
+                if too_many and start < end:
+                    middle = start + (end - start) // 2
+                    for window in ((start, middle), (middle + timedelta(days=1), end)):
+                        pending[executor.submit(copy_context().run, fetch, *window)] = window
+                else:
+                    done[(start, end)] = records
+    merged = {}
+    for window in sorted(done):
+        for record in done[window]:
+            merged.setdefault(record[name], record)
+    return list(merged.values())
+
+
+def in_date_window(record: dict, key: str, start: datetime = None, end: datetime = None) -> bool:
+    '''
+    True when the date in record[key] (dd/mm/yyyy, time ignored) is in [start, end], days only.
+    Records without a readable date are kept. Filters answers of servers that may ignore an end date parameter.
+    '''
+    try:
+        day = datetime.strptime(str(record[key])[:10], '%d/%m/%Y').date()
+    except (KeyError, ValueError):
+        return True
+    return (start is None or start.date() <= day) and (end is None or day <= end.date())
+
+
+class AtendimentosStore():
+    '''
+    Local SQLite copy of AtendimentosPendentesRealizados records, keyed by status and ID_OCORRENCIA,
+    with the date of the last sync (watermark) per status.
+    '''
+    def __init__(self, path: str = None):
+        self.path = os.path.join(CACHE_DIR, 'atendimentos.sqlite') if path is None else path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS atendimentos (status INTEGER, key TEXT, hash TEXT, record TEXT, PRIMARY KEY (status, key))')
+            connection.execute('CREATE TABLE IF NOT EXISTS watermarks (status INTEGER PRIMARY KEY, data TEXT)')
+
+    def __connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def watermark(self, status: int) -> datetime:
+        '''
+        Date of the last sync of status, or None.
+        '''
+        with self.__connect() as connection:
+            row = connection.execute('SELECT data FROM watermarks WHERE status = ?', (status,)).fetchone()
+        return None if row is None else datetime.strptime(row[0], '%d/%m/%Y')
+
+    def upsert(self, status: int, records: list[dict], watermark: datetime, name: str = 'ID_OCORRENCIA') -> list[dict]:
+        '''
+        Inserts new records, updates changed ones and moves the watermark of status.
+        Returns the records that were new or changed.
+        '''
+        deltas = []
+        with self.__connect() as connection:
+            for record in records:
+                text = json.dumps(record, sort_keys=True, default=str)
+                digest = hashlib.sha256(text.encode()).hexdigest()
+                row = connection.execute('SELECT hash FROM atendimentos WHERE status = ? AND key = ?', (status, str(record[name]))).fetchone()
+                if row is None or row[0] != digest:
+                    connection.execute('INSERT OR REPLACE INTO atendimentos VALUES (?, ?, ?, ?)', (status, str(record[name]), digest, text))
+                    deltas.append(record)
+            connection.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', (status, watermark.strftime('%d/%m/%Y')))
+        return deltas
+
+    def records(self, status: int) -> list[dict]:
+        '''
+        Every stored record of status.
+        '''
+        with self.__connect() as connection:
+            return [json.loads(row[0]) for row in connection.execute('SELECT record FROM atendimentos WHERE status = ?', (status,))]
+
+
+class Journal():
+    '''
+    Append-only NDJSON log of a bulk job, so an interrupted job goes on where it stopped.
+    Each item writes a started line before its requests and a done line with its result,
+    both flushed (and fsynced with fsync=True) before going on. Opening the same path again skips done items.
+    A crash in the middle of a line leaves a partial last line, ignored when reading.
+    Usage: with Journal('salvar.ndjson') as journal: router.save(ocorrencias, prioridade, journal=journal)
+    '''
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self.__done: dict[str, dict] = {}
+        self.__started: set[str] = set()
+        self.__lock = threading.Lock()
+        line = '\n'
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry['status'] == 'done':
+                        self.__done[entry['key']] = entry['result']
+                    else:
+                        self.__started.add(entry['key'])
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__file = open(path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        if not line.endswith('\n'):
+            # Ends the partial line, so the next entry starts in a line of its own.
+            self.__file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def key(operation: str, item) -> str:
+        '''
+        Key of item (JSON serializable) in operation. The same input gives the same key in the next run.
+        '''
+        return ResponseCache.key({'operation': operation, 'item': item})
+
+    def result(self, key: str) -> dict:
+        '''
+        Result of a done item, or None.
+        '''
+        with self.__lock:
+            return self.__done.get(key)
+
+    def in_doubt(self, key: str) -> bool:
+        '''
+        True when key started in a previous run and never finished, its requests may have reached Exati.
+        '''
+        with self.__lock:
+            return key in self.__started and key not in self.__done
 
+    def start(self, keys: Iterable[str]):
+        '''
+        Marks keys as started, before sending their requests.
+        '''
+        self.__write([{'key': key, 'status': 'started'} for key in keys])
 
-class ExatiSession(requests.sessions.Session):
-    '''
-    Manage authentication, sessions and a new post request, dealing with Exati responses.
-    '''
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.auth_exati()
+    def done(self, keys: Iterable[str], result: dict):
+        '''
+        Stores result for keys, which are skipped from now on.
+        '''
+        self.__write([{'key': key, 'status': 'done', 'result': result} for key in keys])
 
-    def auth_exati(self):
+    def run(self, func: Callable, items: Iterable, key: Callable, max_workers: int = 1, in_doubt: dict = None) -> Iterator[tuple]:
         '''
-        Returns JWT from authentication response
+        Runs func(item) -> result dict for items not done yet and yields (item, result) for every item.
+        Done items yield their journaled result without calling func. Items in doubt run again,
+        or yield in_doubt when it is given, for commands that are not safe to repeat.
+        With max_workers > 1 a call that raises yields the exception, as map_concurrently, and is not done.
         '''
-        basic_auth = f'Basic {b64encode(os.environ.get("EXATI_USER_PASS").encode()).decode()}'
-        payload = {
-            'CMD_PLATAFORM': 'GUIA',
-            'CMD_COMMAND': 'Login',
-            'parser': 'json'
-        }
-        self.headers = {'Authorization': basic_auth}
-        response = self.ex_post(payload=payload)
-        jwt = response['RAIZ']['AUTH_TOKEN']
-        self.headers = {'Authorization': jwt}
+        pending = []
+        for item in items:
+            item_key = key(item)
+            result = self.result(item_key)
+            if result is not None:
+                yield item, result
+            elif in_doubt is not None and self.in_doubt(item_key):
+                yield item, dict(in_doubt)
+            else:
+                pending.append((item_key, item))
 
-    def ex_post(self, payload: dict, depth=1, warnings=True):
+        def call(entry: tuple):
+            item_key, item = entry
+            self.start([item_key])
+            result = func(item)
+            self.done([item_key], result)
+            return result
+
+        if max_workers == 1:
+            for entry in pending:
+                yield entry[1], call(entry)
+            return
+        for (_, item), result in map_concurrently(call, pending, max_workers=max_workers):
+            yield item, result
+
+    def close(self):
         '''
-        Modification to post method to handle Exati post requests.
+        Closes the log file.
         '''
-        response = self.post(url=os.environ.get('EXATI_URL'), data=payload).json()
-        try:
-            message = response['RAIZ']['MESSAGES']['ERRORS']
-        except KeyError:
-            if warnings:
-                print(f'KeyError de RAIZ, {response}')
-            response = self.ex_post(payload=payload, depth=depth + 1, warnings=warnings)
-            message = response['RAIZ']['MESSAGES']['ERRORS']
-        if message:
-            if warnings:
-                print(f'{message}, depth = {depth}')
-            if depth > 3:
-                return response
-            sleep(0.25)
-            response = self.ex_post(payload=payload, depth=depth + 1, warnings=warnings)
-        return response
+        self.__file.close()
+
+    def __write(self, entries: list[dict]):
+        with self.__lock:
+            for entry in entries:
+                self.__file.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+                if entry['status'] == 'done':
+                    self.__done[entry['key']] = entry['result']
+                else:
+                    self.__started.add(entry['key'])
+            self.__file.flush()
+            if self.fsync:
+                os.fsync(self.__file.fileno())
+
+
+def response_result(response) -> dict:
+    '''
+    RESULTADO and MENSAGEM from a response of a saving command, or from the exception raised instead.
+    '''
+    if isinstance(response, Exception):
+        return {'RESULTADO': 'NOK', 'MENSAGEM': f'Erro: {response!r}'}
+    try:
+        messages = response['RAIZ']['MESSAGES']
+    except (KeyError, TypeError):
+        return {'RESULTADO': 'NOK', 'MENSAGEM': 'Erro não identificado.'}
+    if messages['ERRORS']:
+        return {'RESULTADO': 'NOK', 'MENSAGEM': f'Erro: {messages["ERRORS"][- 1]}'}
+    return {'RESULTADO': 'OK', 'MENSAGEM': messages['INFORMATIONS'][- 1] if messages['INFORMATIONS'] else ''}
 
 
 class AtendimentosPendentesRealizados():
@@ -138,6 +1786,26 @@ class AtendimentosPendentesRealizados():
         data_inicio and data_final format -> %d/%m/%Y
         status -> 0 = Pendente. 1 = Realizado. - 1 = Todos.
         '''
+        self.records = self.__fetch(data_inicio, data_final, status)
+        return self.records
+
+    def export_sharded(self, data_inicio: str, data_final: str, status: int, slice_days: int = 7, max_workers: int = 4,
+                       max_rows: int = None, name='ID_OCORRENCIA') -> list[dict]:
+        '''
+        Same as export, requesting slices of slice_days concurrently. See export_sharded.
+        '''
+        def fetch(start: datetime, end: datetime) -> list[dict]:
+            return self.__fetch(start.strftime('%d/%m/%Y'), end.strftime('%d/%m/%Y'), status)
+        self.records = export_sharded(
+            fetch, datetime.strptime(data_inicio, '%d/%m/%Y'), datetime.strptime(data_final, '%d/%m/%Y'), name,
+            slice_days=slice_days, max_workers=max_workers, max_rows=max_rows
+        )
+        return self.records
+
+    def __fetch(self, data_inicio: str, data_final: str, status: int) -> list[dict]:
+        '''
+        Request records without touching self.records.
+        '''
         payload = {
             'CMD_ID_PARQUE_SERVICO': 1,
             'CMD_DATA_INICIO': data_inicio,
@@ -147,8 +1815,7 @@ class AtendimentosPendentesRealizados():
             'parser': 'json'
         }
         response = self.session.ex_post(payload=payload)
-        self.records = response['RAIZ']['PONTOS_STATUS_ATENDIMENTO']['PONTO_STATUS_ATENDIMENTO']
-        return self.records
+        return response['RAIZ']['PONTOS_STATUS_ATENDIMENTO']['PONTO_STATUS_ATENDIMENTO']
 
     def name_to_records(self, data_inicio: str, data_final: str, status: int, name='ID_OCORRENCIA') -> dict[str, dict]:
         '''
@@ -157,6 +1824,21 @@ class AtendimentosPendentesRealizados():
         self.export(data_inicio, data_final, status)
         return {atb[name]: atb for atb in self.records}
 
+    def sync(self, store: AtendimentosStore, status: int, data_inicio: datetime = None, overlap_days: int = 2, name='ID_OCORRENCIA') -> list[dict]:
+        '''
+        Incremental export. Requests only from the last sync of status minus overlap_days
+        until today, stores the records in store and returns the new or changed ones.
+        data_inicio -> start of the first sync. Default is 30 days ago.
+        '''
+        today = datetime.today()
+        watermark = store.watermark(status)
+        if watermark is not None:
+            data_inicio = watermark - timedelta(days=overlap_days)
+        elif data_inicio is None:
+            data_inicio = today - timedelta(days=30)
+        self.export(data_inicio.strftime('%d/%m/%Y'), today.strftime('%d/%m/%Y'), status)
+        return store.upsert(status, self.records, today, name)
+
 
 class AtendimentoPorPontoServico():
     '''
@@ -165,6 +1847,7 @@ class AtendimentoPorPontoServico():
     def __init__(self, session: ExatiSession):
         self.session = session
         self.records: list[dict] = None
+        self.errors: dict[int, Exception] = {}
 
     def export(self, ps: int) -> list[dict]:
         '''
@@ -172,6 +1855,43 @@ class AtendimentoPorPontoServico():
         ps = ID_PONTO_SERVICO.
         first index from records is the newest record.
         '''
+        self.records = self.__fetch(ps)
+        return self.records
+
+    def get_status_motivo_date(self, ps: int) -> tuple[str, str, datetime]:
+        '''
+        Return a tuple with information about status, motivo and date.
+        '''
+        return self.__status_motivo_date(self.export(ps)[0])
+
+    def iter_status_motivo_date(self, ids_ps: Iterable[int], max_workers: int = 8) -> Iterator[tuple[int, tuple]]:
+        '''
+        Yields (ps, (status, motivo, date)) as each request finishes.
+        Requests run in a thread pool with max_workers threads.
+        If a request fails, the exception is yielded in place of the tuple.
+        '''
+        def status_motivo_date(ps: int) -> tuple[str, str, datetime]:
+            return self.__status_motivo_date(self.__fetch(ps)[0])
+        yield from map_concurrently(status_motivo_date, ids_ps, max_workers=max_workers)
+
+    def batch_status_motivo_date(self, ids_ps: Iterable[int], max_workers: int = 8) -> dict[int, tuple[str, str, datetime]]:
+        '''
+        Returns {ps: (status, motivo, date)} for every ps in ids_ps.
+        Failed ps are left out of the result and stored in self.errors.
+        '''
+        self.errors = {}
+        results = {}
+        for ps, result in self.iter_status_motivo_date(ids_ps, max_workers=max_workers):
+            if isinstance(result, Exception):
+                self.errors[ps] = result
+            else:
+                results[ps] = result
+        return results
+
+    def __fetch(self, ps: int) -> list[dict]:
+        '''
+        Request records of a ps without touching self.records.
+        '''
         payload = {
             'CMD_ID_PARQUE_SERVICO': 1,
             'CMD_ID_PONTO_SERVICO': ps,
@@ -180,16 +1900,15 @@ class AtendimentoPorPontoServico():
         }
         response = self.session.ex_post(payload=payload)
         try:
-            self.records = response['RAIZ']['ATENDIMENTOS']['ATENDIMENTO']
+            return response['RAIZ']['ATENDIMENTOS']['ATENDIMENTO']
         except KeyError:
-            self.records = [{}]
-        return self.records
+            return [{}]
 
-    def get_status_motivo_date(self, ps: int) -> tuple[str, str, datetime]:
+    @staticmethod
+    def __status_motivo_date(record: dict) -> tuple[str, str, datetime]:
         '''
-        Return a tuple with information about status, motivo and date.
+        Reads status, motivo and date from a record. Records without them are Pendente.
         '''
-        record = self.export(ps)[0]
         try:
             return record['DESC_STATUS_ATENDIMENTO_PS'],\
         record['DESC_MOTIVO_ATENDIMENTO_PS'],\
@@ -206,7 +1925,7 @@ class AtualizarObs():
         self.session = session
         self.records: list[dict] = None
 
-    def mudar(self, ocorrencia: Ocorrencia, nova_obs: str):
+    def mudar(self, ocorrencia: Ocorrencia, nova_obs: str) -> dict:
         '''
         Atualiza a obs de uma
         '''
@@ -218,7 +1937,29 @@ class AtualizarObs():
             'CMD_COMMAND': 'AtualizarObsPontoOcorrencia',
             'parser': 'json'
         }
-        self.session.ex_post(payload=payload)
+        return self.session.ex_post(payload=payload)
+
+    def mudar_bulk(self, novas_obs: Iterable[tuple[Ocorrencia, str]], max_workers: int = 1, journal: Journal = None):
+        '''
+        Atualiza a obs de muitas ocorrências, pairs of (Ocorrencia, nova_obs).
+        Sets RESULTADO and MENSAGEM of each Ocorrencia. With journal, an interrupted run
+        started again with the same pairs skips the ones already updated.
+        '''
+        def mudar(item: tuple[Ocorrencia, str]) -> dict:
+            return response_result(self.mudar(*item))
+
+        items = list(novas_obs)
+        if journal is not None:
+            results = journal.run(mudar, items, lambda item: Journal.key('AtualizarObsPontoOcorrencia', [item[0].ID_OCORRENCIA, item[1]]), max_workers)
+        elif max_workers == 1:
+            results = ((item, mudar(item)) for item in items)
+        else:
+            results = map_concurrently(mudar, items, max_workers=max_workers)
+        for (ocorrencia, nova_obs), result in results:
+            result = response_result(result) if isinstance(result, Exception) else result
+            ocorrencia.OBS = nova_obs
+            ocorrencia.RESULTADO = result['RESULTADO']
+            ocorrencia.MENSAGEM = result['MENSAGEM']
 
     def atualizar_reabertura(self, ocorrencia: Ocorrencia):
         '''
@@ -247,6 +1988,36 @@ class ConsultarAmostraLaudo():
         '''
         Export records from API.
         '''
+        self.records = self.__fetch(laudo)
+        return self.records
+
+    def get_ocorrencias(self, ids_to_ocorrencia: dict[list], laudo: Laudo) -> list[Ocorrencia]:
+        '''
+        Needs dependency injection from Laudo.
+        '''
+        self.export(laudo=laudo)
+        return self.__ocorrencias(self.records, ids_to_ocorrencia)
+
+    def fill_laudos(self, laudos: Iterable[Laudo], ids_to_ocorrencia: dict[list], max_workers: int = 8) -> list[Laudo]:
+        '''
+        Requests samples of many laudos concurrently and fills OCORRENCIAS and NUM_OCORRENCIAS of each one.
+        Laudos that fail get RESULTADO = NOK and the error in MENSAGEM.
+        '''
+        laudos = list(laudos)
+        for laudo, records in map_concurrently(self.__fetch, laudos, max_workers=max_workers):
+            if isinstance(records, Exception):
+                laudo.RESULTADO = 'NOK'
+                laudo.MENSAGEM = f'Erro: {records!r}'
+                continue
+            laudo.OCORRENCIAS = self.__ocorrencias(records, ids_to_ocorrencia)
+            laudo.NUM_OCORRENCIAS = len(laudo.OCORRENCIAS)
+            laudo.RESULTADO = 'OK'
+        return laudos
+
+    def __fetch(self, laudo: Laudo) -> list[dict]:
+        '''
+        Request samples of a laudo without touching self.records.
+        '''
         payload = {
             'CMD_ID_LAUDO': laudo.ID_LAUDO,
             'CMD_AGRUPADO': 0,
@@ -255,16 +2026,14 @@ class ConsultarAmostraLaudo():
             'parser': 'json'
         }
         response = self.session.ex_post(payload=payload)
-        self.records = response['RAIZ']['AMOSTRAS_LAUDO']['AMOSTRA_LAUDO']
-        return self.records
+        return response['RAIZ']['AMOSTRAS_LAUDO']['AMOSTRA_LAUDO']
 
-    def get_ocorrencias(self, ids_to_ocorrencia: dict[list], laudo: Laudo) -> list[Ocorrencia]:
+    def __ocorrencias(self, records: list[dict], ids_to_ocorrencia: dict[list]) -> list[Ocorrencia]:
         '''
-        Needs dependency injection from Laudo.
+        Ocorrencias of samples that have them.
         '''
         ocorrencias: list[Ocorrencia] = []
-        self.export(laudo=laudo)
-        for record in self.records:
+        for record in records:
             if record['POSSUI_OCORRENCIA'] == 1:
                 ocorrencias.extend(self.__split_ocorrencia(record['ID_OCORRENCIA'].split(','), ids_to_ocorrencia))
         return ocorrencias
@@ -288,8 +2057,9 @@ class ConsultarAtributos():
     '''
     Router Consultar Atributos.
     '''
-    def __init__(self, session: ExatiSession):
+    def __init__(self, session: ExatiSession, cache: ResponseCache = None):
         self.session = session
+        self.cache = cache
         self.__records: list[dict] = None
 
     @property
@@ -309,7 +2079,7 @@ class ConsultarAtributos():
             'CMD_COMMAND': 'ConsultarAtributos',
             'parser': 'json'
         }
-        response = self.session.ex_post(payload=payload)
+        response = self.session.ex_post(payload=payload) if self.cache is None else self.cache.fetch(self.session, payload)
         self.__records = response['RAIZ']['ATRIBUTOS']['ATRIBUTO']
         return self.__records
 
@@ -317,16 +2087,16 @@ class ConsultarAtributos():
         '''
         Create a dict with key = name of attribute and values = records
         '''
-        self.export()
-        return {atb[name]: atb for atb in self.__records}
+        return {atb[name]: atb for atb in self.records}
 
 
 class ConsultarEquipes():
     '''
     Router Consultar Equipes
     '''
-    def __init__(self, session: ExatiSession):
+    def __init__(self, session: ExatiSession, cache: ResponseCache = None):
         self.session = session
+        self.cache = cache
         self.__records: list[dict] = None
 
     @property
@@ -349,7 +2119,7 @@ class ConsultarEquipes():
             'CMD_COMMAND': 'ConsultarEquipes',
             'parser': 'json'
         }
-        response = self.session.ex_post(payload=payload)
+        response = self.session.ex_post(payload=payload) if self.cache is None else self.cache.fetch(self.session, payload)
         self.__records = response['RAIZ']['EQUIPES']['EQUIPE']
         return self.__records
 
@@ -359,17 +2129,21 @@ class ConsultarEquipes():
         DESC_EQUIPE
         ID_EQUIPE
         '''
-        self.export()
-        return {atb[name]: atb for atb in self.__records}
+        return {atb[name]: atb for atb in self.records}
 
 
 class ConsultarHistoricoPontoServico():
     '''
     Router ConsultarHistorico
+    Optional cache -> ResponseCache for structure items. Versions never change, so
+    ConsultarItensEstruturaPontoServico is set to never expire in cache.ttl.
     '''
-    def __init__(self, session: ExatiSession):
+    def __init__(self, session: ExatiSession, cache: ResponseCache = None):
         self.session = session
+        self.cache = cache
         self.records: list[dict] = None
+        if cache is not None:
+            cache.ttl.setdefault('ConsultarItensEstruturaPontoServico', None)
 
     def export(self, ps: int) -> list[dict]:
         '''
@@ -394,17 +2168,62 @@ class ConsultarHistoricoPontoServico():
             'CMD_COMMAND': 'ConsultarItensEstruturaPontoServico',
             'parser': 'json'
         }
-        response = self.session.ex_post(payload=payload)
+        response = self.session.ex_post(payload=payload) if self.cache is None else self.cache.fetch(self.session, payload)
         return response['RAIZ']['ITEM_ESTRUTURA_PS']
 
+    def export_versions(self, ps: int, max_workers: int = 8) -> list[dict]:
+        '''
+        Returns the history of ps, oldest first, with the structure items of each version in ITENS.
+        Items of every version are requested concurrently. With cache, only unseen versions are requested.
+        '''
+        versions = self.export(ps)
+        ids_estrutura = {version['ID_ESTRUTURA_PS'] for version in versions if 'ID_ESTRUTURA_PS' in version}
+        items = dict(map_concurrently(self.export_xml, ids_estrutura, max_workers=max_workers))
+        for error in items.values():
+            if isinstance(error, Exception):
+                raise error
+        return [{**version, 'ITENS': items.get(version.get('ID_ESTRUTURA_PS'))} for version in versions]
+
+    @staticmethod
+    def diff_versions(versions: list[dict]) -> list[dict]:
+        '''
+        Structural diff between consecutive versions from export_versions.
+        Each diff has the ID_ESTRUTURA_PS of both versions and the items ADICIONADOS and REMOVIDOS.
+        '''
+        def items(version: dict) -> Counter:
+            itens = version.get('ITENS') or []
+            if isinstance(itens, str):
+                itens = itens.splitlines()
+            elif isinstance(itens, dict):
+                itens = [itens]
+            return Counter(json.dumps(item, sort_keys=True, default=str) for item in itens)
+
+        diffs = []
+        for old, new in zip(versions, versions[1:]):
+            old_items, new_items = items(old), items(new)
+            diffs.append({
+                'ID_ESTRUTURA_PS_ANTERIOR': old.get('ID_ESTRUTURA_PS'),
+                'ID_ESTRUTURA_PS': new.get('ID_ESTRUTURA_PS'),
+                'ADICIONADOS': [json.loads(item) for item in (new_items - old_items).elements()],
+                'REMOVIDOS': [json.loads(item) for item in (old_items - new_items).elements()],
+            })
+        return diffs
+
 
 class ConsultarLaudo():
     '''
     Router Consultar Laudo
+    Laudos of the last download are kept with hash indexes on INDEXED_KEYS,
+    so queries with other filters over the same window don't request them again.
     '''
+    INDEXED_KEYS = ('ID_TIPO_LAUDO', 'ELABORADO', 'ID_EQUIPE')
+
     def __init__(self, session: ExatiSession):
         self.session = session
         self.__records: list[dict] = None
+        self.__window: tuple[str, str] = None
+        self.__laudos: list[dict] = []
+        self.__indexes: dict[str, dict] = {}
 
     @property
     def records(self):
@@ -415,7 +2234,7 @@ class ConsultarLaudo():
             self.export()
         return self.__records
 
-    def export(self, **kwargs) -> list[dict]:
+    def export(self, data_inicial: datetime = None, data_final: datetime = None, refresh: bool = False, **kwargs) -> list[dict]:
         '''
         Export records from API.
         Return dicts that match filters in kwargs.
@@ -423,34 +2242,141 @@ class ConsultarLaudo():
         for the key.
         Ex.: ID_TIPO_LAUDO: (5,)
         Ex.: ELABORADO: (1,)
+        data_inicial -> creation date, default is 30 days ago. data_final -> optional, laudos with DATA after it are also dropped here.
+        refresh -> requests the window again even if it was already downloaded.
+        '''
+        data_inicial = datetime.today() - timedelta(days=30) if data_inicial is None else data_inicial
+        window = (data_inicial.strftime('%d/%m/%Y'), '' if data_final is None else data_final.strftime('%d/%m/%Y'))
+        if refresh or window != self.__window:
+            self.__download(window)
+        self.__records = self.query(**kwargs)
+        return self.__records
+
+    def query(self, **kwargs) -> list[dict]:
+        '''
+        Filters downloaded laudos, same kwargs as export.
+        Indexed keys are answered from the hash indexes, other keys only scan the remaining laudos.
+        '''
+        rows = None
+        for key, values in kwargs.items():
+            if key in self.__indexes:
+                matches = set().union(*(self.__indexes[key].get(value, ()) for value in values))
+                rows = matches if rows is None else rows & matches
+        rows = range(len(self.__laudos)) if rows is None else sorted(rows)
+        scans = {key: values for key, values in kwargs.items() if key not in self.__indexes}
+        return [
+            self.__laudos[row] for row in rows
+            if all(self.__laudos[row].get(key) in values for key, values in scans.items())
+        ]
+
+    def __download(self, window: tuple[str, str]):
+        '''
+        Requests laudos of window and rebuilds indexes.
         '''
-        last_month = (datetime.today() - timedelta(days=30)).strftime('%d/%m/%Y')
         payload = {
             'CMD_ID_PARQUE_SERVICO': 1,
-            'CMD_DATA_CRIACAO_INICIAL': last_month,
+            'CMD_DATA_CRIACAO_INICIAL': window[0],
             'CMD_COMMAND': 'ConsultarLaudo',
             'parser': 'json'
         }
+        if window[1]:
+            payload['CMD_DATA_CRIACAO_FINAL'] = window[1]
         response = self.session.ex_post(payload=payload)
-        response = response['RAIZ']['LAUDOS']['LAUDO']
-        self.__records = [atb for atb in response if all(atb[key] in values for key, values in kwargs.items())]
-        return self.__records
+        self.__laudos = response['RAIZ']['LAUDOS']['LAUDO']
+        if window[1]:
+            # CMD_DATA_CRIACAO_FINAL may be ignored by the server.
+            data_final = datetime.strptime(window[1], '%d/%m/%Y')
+            self.__laudos = [laudo for laudo in self.__laudos if in_date_window(laudo, 'DATA', end=data_final)]
+        self.__window = window
+        self.__indexes = {key: {} for key in self.INDEXED_KEYS}
+        for row, laudo in enumerate(self.__laudos):
+            for key in self.INDEXED_KEYS:
+                if key in laudo:
+                    self.__indexes[key].setdefault(laudo[key], []).append(row)
 
 
 class ConsultarSolicitacao():
     '''
     Router Consultar Solicitacao.
+    Paging stops on a short page, on the total reported by the server, on a page repeating
+    the ID_SOLICITACAO of the previous one (server ignoring PAGE_PARAM) or after MAX_PAGES pages.
     '''
+    PAGE_PARAM = 'CMD_PAGE'
+    END_DATE_PARAM = 'CMD_DATA_RECLAMACAO_FINAL'
+    TOTAL_KEYS = ('TOTAL_REGISTROS', 'TOTAL', 'QTD_REGISTROS')
+    MAX_PAGES = 1000
+
     def __init__(self, session: ExatiSession):
         self.session = session
         self.records: list[dict] = None
+        self.total: int = None
 
-    def export(self, data_inicial: datetime, id_origem: str = '', id_status: int = '') -> list[dict]:
+    def export(self, data_inicial: datetime, id_origem: str = '', id_status: int = '', page_size: int = 5000) -> list[dict]:
         '''
-        Export records from API.
+        Export records from API, walking every page.
         id_status = 3 -> Pendente.
         id_origem = 107 -> Bright City
         '''
+        self.records = list(self.iter_records(data_inicial, id_origem, id_status, page_size))
+        return self.records
+
+    def export_sharded(self, data_inicial: datetime, data_final: datetime = None, id_origem: str = '', id_status: int = '',
+                       slice_days: int = 7, max_workers: int = 4, max_rows: int = None, page_size: int = 5000) -> list[dict]:
+        '''
+        Same as export, requesting slices of slice_days concurrently. See export_sharded.
+        data_final -> default is today.
+        '''
+        def fetch(start: datetime, end: datetime) -> list[dict]:
+            # END_DATE_PARAM may be ignored, so records after end are dropped here, keeping row counts and dedup right.
+            return [record for record in self.__iter_pages(start, id_origem, id_status, page_size, end) if in_date_window(record, 'DATA_RECLAMACAO', start, end)]
+        data_final = datetime.today() if data_final is None else data_final
+        self.records = export_sharded(
+            fetch, data_inicial, data_final, 'ID_SOLICITACAO', slice_days=slice_days, max_workers=max_workers, max_rows=max_rows
+        )
+        return self.records
+
+    def iter_records(self, data_inicial: datetime, id_origem: str = '', id_status: int = '', page_size: int = 5000) -> Iterator[dict]:
+        '''
+        Yields records one at a time, page by page.
+        The next page is requested while the caller processes the current one.
+        self.total has the number of records when the server provides it.
+        '''
+        self.total = None
+        yield from self.__iter_pages(data_inicial, id_origem, id_status, page_size, on_total=self.__set_total)
+
+    def __set_total(self, total: int):
+        self.total = total
+
+    def __iter_pages(self, data_inicial: datetime, id_origem: str, id_status: int, page_size: int,
+                     data_final: datetime = None, on_total: Callable[[int], None] = None) -> Iterator[dict]:
+        '''
+        Yields records of every page, prefetching the next one.
+        on_total is called with the total reported by the server, if any.
+        '''
+        count = 0
+        previous = None
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='exati') as executor:
+            page = 1
+            future = executor.submit(copy_context().run, self.__page, data_inicial, id_origem, id_status, page_size, page, data_final)
+            while future is not None:
+                records, total = future.result()
+                ids = [record.get('ID_SOLICITACAO') for record in records]
+                if ids and ids == previous:
+                    return
+                previous = ids
+                if total is not None and on_total is not None:
+                    on_total(total)
+                count += len(records)
+                last_page = len(records) < page_size or (total is not None and count >= total) or page >= self.MAX_PAGES
+                page += 1
+                future = None if last_page else executor.submit(copy_context().run, self.__page, data_inicial, id_origem, id_status, page_size, page, data_final)
+                yield from records
+
+    def __page(self, data_inicial: datetime, id_origem: str, id_status: int, page_size: int, page: int,
+               data_final: datetime = None) -> tuple[list[dict], int]:
+        '''
+        Request a page of records. Returns records and the total reported by the server, or None.
+        '''
         payload = {
             'CMD_IDS_PARQUE_SERVICO': 1,
             'CMD_DATA_RECLAMACAO': data_inicial.strftime('%d/%m/%Y'),
@@ -461,12 +2387,21 @@ class ConsultarSolicitacao():
             'CMD_PENDENTE_APROVACAO': -1,
             'CMD_CONSULTAR_REABERTAS': 0,
             'CMD_SOMENTE_VINCULADOS': 0,
-            'CMD_PAGE_SIZE': 5000,
+            'CMD_PAGE_SIZE': page_size,
+            self.PAGE_PARAM: page,
             'parser': 'json'
         }
+        if data_final is not None:
+            payload[self.END_DATE_PARAM] = data_final.strftime('%d/%m/%Y')
         response = self.session.ex_post(payload=payload)
-        self.records = response['RAIZ']['SOLICITACOES']['SOLICITACAO']
-        return self.records
+        solicitacoes = response['RAIZ'].get('SOLICITACOES') or {}
+        total = None
+        for key in self.TOTAL_KEYS:
+            total = response['RAIZ'].get(key, solicitacoes.get(key))
+            if total is not None:
+                total = int(total)
+                break
+        return solicitacoes.get('SOLICITACAO') or [], total
 
 
 class IDsParqueServico():
@@ -492,20 +2427,18 @@ class IDsParqueServico():
         Useful attributes filters:
         Relé type == LCU -> 21;0;409
         '''
-        atb_ids: list[str] = [] if atb_ids is None else map(str, atb_ids)
-        payload = {
-            'CMD_IDS_PARQUE_SERVICO': 1,
-            'CMD_COMMAND': 'ConsultarPontosServicos',
-            'CMD_SEM_PAGINACAO': 0,
-            "CMD_ID_ITEM": mat_id,
-            'CMD_ATRIBUTOS_EXPORTACAO': ','.join(atb_ids),
-            'CMD_FILTRO_ATRIBUTOS': filtros,
-            'parser': 'json'
-        }
-        response = self.session.ex_post(payload=payload)
+        response = self.session.ex_post(payload=self.__payload(atb_ids, mat_id, filtros))
         self.__records = response['RAIZ']['PONTOS_SERVICOS']['PONTO_SERVICO']
         return self.__records
 
+    def iter_records(self, atb_ids: list[str] = None, mat_id: str = '', filtros: str = '', fields: Iterable[str] = None) -> Iterator[dict]:
+        '''
+        Streaming version of export. Yields each PONTO_SERVICO while the response is downloaded,
+        without keeping records in memory.
+        fields -> keys to keep in each record. None keeps every key.
+        '''
+        yield from self.session.ex_post_stream(self.__payload(atb_ids, mat_id, filtros), 'PONTO_SERVICO', fields)
+
     def name_to_records(self, atb_ids: list[str] = None, filtros: str='', name='ID_PONTO_SERVICO')\
         -> dict[str, dict]:
         '''
@@ -514,13 +2447,31 @@ class IDsParqueServico():
         self.export(atb_ids, filtros)
         return {atb[name]: atb for atb in self.__records}
 
+    @staticmethod
+    def __payload(atb_ids: list[str], mat_id: str, filtros: str) -> dict:
+        '''
+        ConsultarPontosServicos payload, shared by export and iter_records.
+        '''
+        atb_ids: list[str] = [] if atb_ids is None else map(str, atb_ids)
+        return {
+            'CMD_IDS_PARQUE_SERVICO': 1,
+            'CMD_COMMAND': 'ConsultarPontosServicos',
+            'CMD_SEM_PAGINACAO': 0,
+            "CMD_ID_ITEM": mat_id,
+            'CMD_ATRIBUTOS_EXPORTACAO': ','.join(atb_ids),
+            'CMD_FILTRO_ATRIBUTOS': filtros,
+            'parser': 'json'
+        }
+
 
 class PrioridadeTipoOcorrencia():
     '''
     Router for get info about ocorrencia priority
+    Optional cache -> ResponseCache, shares priorities with other instances and processes.
     '''
-    def __init__(self, session: ExatiSession):
+    def __init__(self, session: ExatiSession, cache: ResponseCache = None):
         self.session = session
+        self.cache = cache
         self.__caching = {}
 
     def add_priority(self, ocorrencia: Ocorrencia):
@@ -528,18 +2479,36 @@ class PrioridadeTipoOcorrencia():
         Add property SIGLA_PRIORIDADE_PONTO_OCORR to Ocorrencia
         '''
         if ocorrencia.ID_TIPO_OCORRENCIA not in self.__caching:
-            payload = {
-            'CMD_ID_TIPO_OCORRENCIA': ocorrencia.ID_TIPO_OCORRENCIA,
-            'CMD_COMMAND': 'ConsultarPrioridadeTipoOcorrencia',
-            'parser': 'json'
-            }
-            response = self.session.ex_post(payload=payload)
-            ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR = response['RAIZ']\
-                ['PRIORIDADES_TIPO_OCORRENCIA']\
-                    ['PRIORIDADE_TIPO_OCORRENCIA'][0]['SIGLA_PRIORIDADE_PONTO_OCORR']
-            self.__caching[ocorrencia.ID_TIPO_OCORRENCIA] = ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR
-        else:
-            ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR = self.__caching[ocorrencia.ID_TIPO_OCORRENCIA]
+            self.__caching[ocorrencia.ID_TIPO_OCORRENCIA] = self.__fetch(ocorrencia.ID_TIPO_OCORRENCIA)
+        ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR = self.__caching[ocorrencia.ID_TIPO_OCORRENCIA]
+
+    def prefetch(self, ids_tipo: Iterable[int] = None, max_workers: int = 8) -> dict[int, str]:
+        '''
+        Resolves priorities concurrently in one pass.
+        ids_tipo defaults to every ID_TIPO_OCORRENCIA from TipoOcorrencia.
+        Tipos that fail are left for add_priority to request again.
+        '''
+        if ids_tipo is None:
+            ids_tipo = [tipo['ID_TIPO_OCORRENCIA'] for tipo in TipoOcorrencia(session=self.session, cache=self.cache).records]
+        missing = {id_tipo for id_tipo in ids_tipo if id_tipo not in self.__caching}
+        for id_tipo, sigla in map_concurrently(self.__fetch, missing, max_workers=max_workers):
+            if not isinstance(sigla, Exception):
+                self.__caching[id_tipo] = sigla
+        return self.__caching
+
+    def __fetch(self, id_tipo: int) -> str:
+        '''
+        Request SIGLA_PRIORIDADE_PONTO_OCORR of a tipo.
+        '''
+        payload = {
+        'CMD_ID_TIPO_OCORRENCIA': id_tipo,
+        'CMD_COMMAND': 'ConsultarPrioridadeTipoOcorrencia',
+        'parser': 'json'
+        }
+        response = self.session.ex_post(payload=payload) if self.cache is None else self.cache.fetch(self.session, payload)
+        return response['RAIZ']\
+            ['PRIORIDADES_TIPO_OCORRENCIA']\
+                ['PRIORIDADE_TIPO_OCORRENCIA'][0]['SIGLA_PRIORIDADE_PONTO_OCORR']
 
 
 class SalvarAtributosPontosServico():
@@ -555,12 +2524,60 @@ class SalvarAtributosPontosServico():
         Salva valores de atributos em um ponto de serviço.
         '''
         records = self.construct_payload(ps, atb_value, id_esquema, entidade)
-        payload = {
-            'CMD_ATRIBUTOS': str(records),
-            'CMD_COMMAND': 'SalvarAtributosPontosServico',
-            'parser': 'json'
-        }
-        return self.session.ex_post(payload=payload)
+        return self.__post(records)
+
+    def save_bulk(self, ps_atb_value: dict[int, dict], id_esquema: int = 15, entidade: str = "ATRIBUTO_PONTO_SERVICO",
+                  max_batch_bytes: int = 65536, max_workers: int = 4, journal: Journal = None) -> dict[int, dict]:
+        '''
+        Salva atributos de muitos pontos de serviço.
+        ps_atb_value -> key = ID_PONTO_SERVICO, value = atb_value as in save.
+        Points are packed in CMD_ATRIBUTOS batches up to max_batch_bytes, sent concurrently.
+        A batch answered with ERRORS is split in halves and sent again, down to single points,
+        so only the rejected points get NOK.
+        Returns {ps: {'RESULTADO': OK/NOK, 'MENSAGEM': message}} for every point.
+        With journal, points saved in an interrupted run keep their results and are not sent again.
+        Points of batches that raised are not journaled, so they are sent in the next run.
+        '''
+        keys = {}
+        results = {}
+        if journal is not None:
+            keys = {ps: Journal.key('SalvarAtributosPontosServico', [ps, atb_value, id_esquema, entidade]) for ps, atb_value in ps_atb_value.items()}
+            results = {ps: result for ps, result in ((ps, journal.result(key)) for ps, key in keys.items()) if result is not None}
+        batches: list[list[tuple[int, list[dict]]]] = []
+        size = max_batch_bytes
+        for ps, atb_value in ps_atb_value.items():
+            if ps in results:
+                continue
+            records = self.construct_payload(ps, atb_value, id_esquema, entidade)
+            records_size = len(json.dumps(records, ensure_ascii=False))
+            if size + records_size > max_batch_bytes:
+                batches.append([])
+                size = 2
+            batches[-1].append((ps, records))
+            size += records_size
+
+        def post(points: list[tuple[int, list[dict]]]) -> list[tuple[list[int], dict]]:
+            ids_ps = [ps for ps, _ in points]
+            if journal is not None:
+                journal.start(keys[ps] for ps in ids_ps)
+            try:
+                response = self.__post([record for _, records in points for record in records])
+            except Exception as error:  # pylint: disable=broad-except
+                return [(ids_ps, error)]
+            if len(points) > 1 and response_result(response)['RESULTADO'] == 'NOK':
+                middle = len(points) // 2
+                return post(points[:middle]) + post(points[middle:])
+            return [(ids_ps, response)]
+
+        for _, outcomes in map_concurrently(post, batches, max_workers=max_workers):
+            if isinstance(outcomes, Exception):
+                raise outcomes
+            for ids_ps, response in outcomes:
+                result = response_result(response)
+                results.update({ps: dict(result) for ps in ids_ps})
+                if journal is not None and not isinstance(response, Exception):
+                    journal.done([keys[ps] for ps in ids_ps], result)
+        return results
 
     def construct_payload(self, ps: int, atb_value: dict, id_esquema: int, entidade: str) -> list[dict]:
         '''
@@ -569,57 +2586,136 @@ class SalvarAtributosPontosServico():
         '''
         return [{"ID_PONTO_SERVICO": ps, "ID_ATRIBUTO": key, "ID_ESQUEMA_ATRIBUTOS": id_esquema, "ENTIDADE": entidade, "VALOR": value} for key, value in atb_value.items()]
 
+    def __post(self, records: list[dict]) -> dict:
+        '''
+        Sends records as CMD_ATRIBUTOS, JSON encoded.
+        '''
+        payload = {
+            'CMD_ATRIBUTOS': json.dumps(records, ensure_ascii=False),
+            'CMD_COMMAND': 'SalvarAtributosPontosServico',
+            'parser': 'json'
+        }
+        return self.session.ex_post(payload=payload)
+
 
 class SalvarExcluirOcorrencia():
     '''
     Router for saving a new Ocorrencia in Exati API.
+    max_workers in save and delete -> number of ocorrencias processed in parallel.
+    journal in save and delete -> optional Journal. Ocorrencias finished in an interrupted run keep
+    their RESULTADO and MENSAGEM and are not sent again. A save interrupted after sending is not
+    repeated, to avoid duplicates: it gets RESULTADO = NOK and IN_DOUBT as MENSAGEM.
     '''
+    IN_DOUBT = 'Envio interrompido, verificar no Exati se a ocorrência foi criada.'
+    # Journal keys use only fields the router never writes, so a rerun with the same objects finds them.
+    JOURNAL_FIELDS = {
+        'SalvarSolicitacaoPontoServico': ('ID_PONTO_SERVICO', 'DATA_RECLAMACAO', 'HORA_RECLAMACAO', 'ID_TIPO_OCORRENCIA', 'ID_TIPO_ORIGEM_OCORRENCIA', 'OBS'),
+        'ExcluirSolicitacao': ('ID_PONTO_SERVICO', 'ID_OCORRENCIA', 'ID_SOLICITACAO'),
+    }
+
     def __init__(self, session: ExatiSession):
         self.session = session
 
-    def save(self, ocorrencias: list[Ocorrencia], prioridade: PrioridadeTipoOcorrencia):
+    def save(self, ocorrencias: list[Ocorrencia], prioridade: PrioridadeTipoOcorrencia, max_workers: int = 1, journal: Journal = None):
         '''
         Create in Exati - save - Ocorrencia from a list of Ocorrencia.
+        Priorities are prefetched concurrently before the loop.
         '''
-        for ocorrencia in ocorrencias:
-            if self.__check_invalid_ocorrencia_propertys(ocorrencia):
-                continue
-            prioridade.add_priority(ocorrencia=ocorrencia)
-            payload = {
-                'CMD_ID_PONTO_SERVICO': ocorrencia.ID_PONTO_SERVICO,
-                'CMD_DATA_RECLAMACAO': ocorrencia.DATA_RECLAMACAO,
-                'CMD_HORA_RECLAMACAO': ocorrencia.HORA_RECLAMACAO,
-                'CMD_ID_TIPO_ORIGEM_OCORRENCIA': ocorrencia.ID_TIPO_ORIGEM_OCORRENCIA,
-                'CMD_ID_TIPO_OCORRENCIA': ocorrencia.ID_TIPO_OCORRENCIA,
-                'CMD_COMMAND': 'SalvarSolicitacaoPontoServico',
-                'CMD_OBS': ocorrencia.OBS,
-                'CMD_SIGLA_PRIORIDADE_PONTO_OCORR': ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR,
-                'parser': 'json',
-            }
-            response = self.session.ex_post(payload=payload)
-            self.__response_message(response, ocorrencia)
+        prioridade.prefetch({ocorrencia.ID_TIPO_OCORRENCIA for ocorrencia in ocorrencias if ocorrencia.ID_TIPO_OCORRENCIA is not None})
+        in_doubt = {'RESULTADO': 'NOK', 'MENSAGEM': self.IN_DOUBT}
+        self.__run(partial(self.__save, prioridade=prioridade), ocorrencias, max_workers, journal, 'SalvarSolicitacaoPontoServico', in_doubt)
 
-    def delete(self, ocorrencias: list[Ocorrencia]):
+    def delete(self, ocorrencias: list[Ocorrencia], max_workers: int = 1, journal: Journal = None):
         '''
         Delete in Exati Ocorrencia from a list of Ocorrencia
+        With max_workers > 1, the validation requests of each Ocorrencia also run concurrently,
+        in one shared pool, and every request of the job counts in the same max_workers limit.
         '''
-        for ocorrencia in ocorrencias:
-            if self.__check_reopen(ocorrencia) or self.__check_reprogramacao(ocorrencia):
-                continue
-            for id_solicitao in ocorrencia.ID_SOLICITACAO:
-                payload = {
-                    'CMD_ID_SOLICITACAO':id_solicitao,
-                    'CMD_COMMAND': 'CancelarElaboracaoSolicitacao',
-                    'parser': 'json',
-                }
-                response = self.session.ex_post(payload=payload)
-                payload = {
-                    'CMD_ID_SOLICITACAO':id_solicitao,
-                    'CMD_COMMAND': 'ExcluirSolicitacao',
-                    'parser': 'json',
-                }
-                response = self.session.ex_post(payload=payload)
-            self.__response_message(response, ocorrencia)
+        if max_workers == 1:
+            self.__run(self.__delete, ocorrencias, max_workers, journal, 'ExcluirSolicitacao')
+            return
+        slots = threading.BoundedSemaphore(max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='exati') as checks:
+            self.__run(partial(self.__delete, checks=checks, slots=slots), ocorrencias, max_workers, journal, 'ExcluirSolicitacao')
+
+    def __run(self, func: Callable, ocorrencias: list[Ocorrencia], max_workers: int, journal: Journal = None,
+              operation: str = None, in_doubt: dict = None):
+        '''
+        Runs func for each Ocorrencia, in order when max_workers is 1.
+        In parallel, an Ocorrencia that raises gets RESULTADO = NOK and the others go on.
+        '''
+        if journal is not None:
+            def run(ocorrencia: Ocorrencia) -> dict:
+                func(ocorrencia)
+                return {'RESULTADO': ocorrencia.RESULTADO, 'MENSAGEM': ocorrencia.MENSAGEM}
+
+            def key(ocorrencia: Ocorrencia) -> str:
+                item = {name: getattr(ocorrencia, name) for name in self.JOURNAL_FIELDS[operation]}
+                if 'OBS' in item and item['OBS'] is None:
+                    # __save sends OBS None as ''.
+                    item['OBS'] = ''
+                return Journal.key(operation, item)
+
+            for ocorrencia, result in journal.run(run, ocorrencias, key, max_workers, in_doubt):
+                result = response_result(result) if isinstance(result, Exception) else result
+                ocorrencia.RESULTADO = result['RESULTADO']
+                ocorrencia.MENSAGEM = result['MENSAGEM']
+            return
+        if max_workers == 1:
+            for ocorrencia in ocorrencias:
+                func(ocorrencia)
+            return
+        for ocorrencia, error in map_concurrently(func, ocorrencias, max_workers=max_workers):
+            if isinstance(error, Exception):
+                ocorrencia.RESULTADO = 'NOK'
+                ocorrencia.MENSAGEM = f'Erro: {error!r}'
+
+    def __save(self, ocorrencia: Ocorrencia, prioridade: PrioridadeTipoOcorrencia):
+        '''
+        Create a single Ocorrencia.
+        '''
+        if self.__check_invalid_ocorrencia_propertys(ocorrencia):
+            return
+        prioridade.add_priority(ocorrencia=ocorrencia)
+        payload = {
+            'CMD_ID_PONTO_SERVICO': ocorrencia.ID_PONTO_SERVICO,
+            'CMD_DATA_RECLAMACAO': ocorrencia.DATA_RECLAMACAO,
+            'CMD_HORA_RECLAMACAO': ocorrencia.HORA_RECLAMACAO,
+            'CMD_ID_TIPO_ORIGEM_OCORRENCIA': ocorrencia.ID_TIPO_ORIGEM_OCORRENCIA,
+            'CMD_ID_TIPO_OCORRENCIA': ocorrencia.ID_TIPO_OCORRENCIA,
+            'CMD_COMMAND': 'SalvarSolicitacaoPontoServico',
+            'CMD_OBS': ocorrencia.OBS,
+            'CMD_SIGLA_PRIORIDADE_PONTO_OCORR': ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR,
+            'parser': 'json',
+        }
+        response = self.session.ex_post(payload=payload)
+        self.__response_message(response, ocorrencia)
+
+    def __delete(self, ocorrencia: Ocorrencia, checks: ThreadPoolExecutor = None, slots: threading.Semaphore = None):
+        '''
+        Delete a single Ocorrencia.
+        checks -> pool for the validation requests, run concurrently. slots -> limit of requests in flight.
+        '''
+        if checks is not None:
+            if self.__check_concurrently(ocorrencia, checks, slots):
+                return
+        elif self.__check_reopen(ocorrencia) or self.__check_reprogramacao(ocorrencia):
+            return
+        response = None
+        for id_solicitao in ocorrencia.ID_SOLICITACAO:
+            payload = {
+                'CMD_ID_SOLICITACAO':id_solicitao,
+                'CMD_COMMAND': 'CancelarElaboracaoSolicitacao',
+                'parser': 'json',
+            }
+            response = self.__post(payload, slots)
+            payload = {
+                'CMD_ID_SOLICITACAO':id_solicitao,
+                'CMD_COMMAND': 'ExcluirSolicitacao',
+                'parser': 'json',
+            }
+            response = self.__post(payload, slots)
+        self.__response_message(response, ocorrencia)
 
     def __check_invalid_ocorrencia_propertys(self, ocorrencia: Ocorrencia) -> bool:
         '''
@@ -645,14 +2741,7 @@ class SalvarExcluirOcorrencia():
         Checks if a Ocorrencia has "impossibilidade".
         '''
         for id_solicitao in ocorrencia.ID_SOLICITACAO:
-            payload = {
-                'CMD_ID_SOLICITACAO':id_solicitao,
-                'CMD_COMMAND': 'ConsultarDetalhesSolicitacao',
-                'parser': 'json',
-            }
-            response = self.session.ex_post(payload=payload)
-            num_reopen = response['RAIZ']['SOLICITACAO'].get('POSSUI_ATENDIMENTO_ANTERIOR', 0)
-            if int(num_reopen) >= 1:
+            if self.__has_reopen(id_solicitao):
                 ocorrencia.MENSAGEM = 'Solicitação possui reabertura. Não foi possível excluir.'
                 ocorrencia.RESULTADO = 'NOK'
                 return True
@@ -662,18 +2751,65 @@ class SalvarExcluirOcorrencia():
         '''
         Checks if a Ocorrencia has "reprogramação".
         '''
+        if self.__has_reprogramacao(ocorrencia):
+            ocorrencia.MENSAGEM = 'Ocorrência possui reabertura. Não foi possível excluir.'
+            ocorrencia.RESULTADO = 'NOK'
+            return True
+        return False
+
+    def __check_concurrently(self, ocorrencia: Ocorrencia, checks: ThreadPoolExecutor, slots: threading.Semaphore) -> bool:
+        '''
+        Same checks as __check_reopen and __check_reprogramacao, with the requests submitted to checks at the same time.
+        Messages follow the same precedence as the serial checks.
+        '''
+        calls = [partial(self.__has_reopen, id_solicitao, slots) for id_solicitao in ocorrencia.ID_SOLICITACAO]
+        calls.append(partial(self.__has_reprogramacao, ocorrencia, slots))
+        futures = [checks.submit(copy_context().run, call) for call in calls]
+        results = [future.result() for future in futures]
+        if any(results[:-1]):
+            ocorrencia.MENSAGEM = 'Solicitação possui reabertura. Não foi possível excluir.'
+            ocorrencia.RESULTADO = 'NOK'
+            return True
+        if results[-1]:
+            ocorrencia.MENSAGEM = 'Ocorrência possui reabertura. Não foi possível excluir.'
+            ocorrencia.RESULTADO = 'NOK'
+            return True
+        return False
+
+    def __has_reopen(self, id_solicitao: int, slots: threading.Semaphore = None) -> bool:
+        '''
+        Checks if a Solicitacao has "atendimento anterior".
+        '''
+        payload = {
+            'CMD_ID_SOLICITACAO':id_solicitao,
+            'CMD_COMMAND': 'ConsultarDetalhesSolicitacao',
+            'parser': 'json',
+        }
+        response = self.__post(payload, slots)
+        num_reopen = response['RAIZ']['SOLICITACAO'].get('POSSUI_ATENDIMENTO_ANTERIOR', 0)
+        return int(num_reopen) >= 1
+
+    def __has_reprogramacao(self, ocorrencia: Ocorrencia, slots: threading.Semaphore = None) -> bool:
+        '''
+        Checks if a Ocorrencia has "reprogramação" without changing it.
+        '''
         payload = {
             'CMD_ID_OCORRENCIA':ocorrencia.ID_OCORRENCIA,
             'CMD_COMMAND': 'ConsultarPontosServicoOcorrenciaNovo',
             'parser': 'json',
         }
-        response = self.session.ex_post(payload=payload)
+        response = self.__post(payload, slots)
         record = response['RAIZ']['PONTOS_SERVICOS_OCORRENCIA']['PONTO_SERVICO_OCORRENCIA'][0]
-        if 'ID_REPROGRAMACAO_ATUAL' in record:
-            ocorrencia.MENSAGEM = 'Ocorrência possui reabertura. Não foi possível excluir.'
-            ocorrencia.RESULTADO = 'NOK'
-            return True
-        return False
+        return 'ID_REPROGRAMACAO_ATUAL' in record
+
+    def __post(self, payload: dict, slots: threading.Semaphore = None) -> dict:
+        '''
+        ex_post holding one of slots, when given.
+        '''
+        if slots is None:
+            return self.session.ex_post(payload=payload)
+        with slots:
+            return self.session.ex_post(payload=payload)
 
     def __response_message(self, response, ocorrencia: Ocorrencia):
         '''
@@ -697,8 +2833,9 @@ class TipoOcorrencia():
     '''
     Router Tipo Ocorrencia.
     '''
-    def __init__(self, session: ExatiSession):
+    def __init__(self, session: ExatiSession, cache: ResponseCache = None):
         self.session = session
+        self.cache = cache
         self.__records: list[dict] = None
 
     @property
@@ -719,7 +2856,7 @@ class TipoOcorrencia():
             'CMD_COMMAND': 'ConsultarTipoOcorrencia',
             'parser': 'json'
         }
-        response = self.session.ex_post(payload=payload)
+        response = self.session.ex_post(payload=payload) if self.cache is None else self.cache.fetch(self.session, payload)
         self.__records = response['RAIZ']['TIPOS_OCORRENCIA']['TIPO_OCORRENCIA']
         return self.__records
 
@@ -727,5 +2864,4 @@ class TipoOcorrencia():
         '''
         Create a dict with key = name of attribute and values = records
         '''
-        self.export()
-        return {atb[name]: atb for atb in self.__records}
+        return {atb[name]: atb for atb in self.records}
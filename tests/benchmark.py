@@ -0,0 +1,126 @@
+'''
+Benchmarks routers and ex_post retries against the local FakeExati server.
+Usage: python -m tests.benchmark [--size 2000] [--latency 0.005] [--repeat 20]
+'''
+
+import os
+import argparse
+import statistics
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from exati import ExatiSession, RetryPolicy, Laudo, Ocorrencia
+from exati import AtendimentoPorPontoServico, AtendimentosPendentesRealizados, ConsultarAmostraLaudo, ConsultarAtributos
+from exati import ConsultarHistoricoPontoServico, ConsultarLaudo, ConsultarSolicitacao, IDsParqueServico
+from exati import SalvarAtributosPontosServico, TipoOcorrencia, ConsultarEquipes, PrioridadeTipoOcorrencia
+from exati import AtualizarObs, SalvarExcluirOcorrencia
+from tests.fake_exati import FakeExati
+
+
+def measure(name: str, func, repeat: int) -> dict:
+    '''
+    Runs func repeat times and returns latency statistics in milliseconds.
+    '''
+    latencies = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        latencies.append((perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        'name': name,
+        'runs': repeat,
+        'ops_s': repeat / (sum(latencies) / 1000),
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def benchmarks(session: ExatiSession, size: int) -> dict:
+    '''
+    Named callables exercising each router.
+    '''
+    today = datetime.today()
+    ids_ps = list(range(1, min(size, 200) + 1))
+    ids_ocorrencia = ids_ps[:50]
+
+    def novas() -> list[Ocorrencia]:
+        return [Ocorrencia(ID_PONTO_SERVICO=ps, DATA_RECLAMACAO=today.strftime('%d/%m/%Y'), HORA_RECLAMACAO='10:00',
+                           ID_TIPO_OCORRENCIA=ps % 10 + 1, ID_TIPO_ORIGEM_OCORRENCIA=1) for ps in ids_ocorrencia]
+
+    return {
+        'ConsultarAtributos.export': lambda: ConsultarAtributos(session=session).export(),
+        'ConsultarEquipes.export': lambda: ConsultarEquipes(session=session).export(),
+        'TipoOcorrencia.export': lambda: TipoOcorrencia(session=session).export(),
+        'PrioridadeTipoOcorrencia.prefetch': lambda: PrioridadeTipoOcorrencia(session=session).prefetch(),
+        'IDsParqueServico.export': lambda: IDsParqueServico(session=session).export(),
+        'IDsParqueServico.iter_records': lambda: sum(1 for _ in IDsParqueServico(session=session).iter_records(fields=('ID_PONTO_SERVICO',))),
+        'AtendimentosPendentesRealizados.export': lambda: AtendimentosPendentesRealizados(session=session).export(
+            (today - timedelta(days=120)).strftime('%d/%m/%Y'), today.strftime('%d/%m/%Y'), -1
+        ),
+        'AtendimentosPendentesRealizados.export_sharded': lambda: AtendimentosPendentesRealizados(session=session).export_sharded(
+            (today - timedelta(days=120)).strftime('%d/%m/%Y'), today.strftime('%d/%m/%Y'), -1
+        ),
+        'AtendimentoPorPontoServico.get_status_motivo_date': lambda: AtendimentoPorPontoServico(session=session).get_status_motivo_date(2),
+        'AtendimentoPorPontoServico.batch_status_motivo_date': lambda: AtendimentoPorPontoServico(session=session).batch_status_motivo_date(ids_ps),
+        'ConsultarSolicitacao.export': lambda: ConsultarSolicitacao(session=session).export(today - timedelta(days=120), page_size=100),
+        'ConsultarLaudo.export': lambda: ConsultarLaudo(session=session).export(ID_TIPO_LAUDO=(5, 7), ELABORADO=(1,)),
+        'ConsultarAmostraLaudo.fill_laudos': lambda: ConsultarAmostraLaudo(session=session).fill_laudos(
+            [Laudo(ID_LAUDO=laudo) for laudo in range(1, 21)], {}
+        ),
+        'ConsultarHistoricoPontoServico.export_versions': lambda: ConsultarHistoricoPontoServico(session=session).export_versions(1),
+        'SalvarAtributosPontosServico.save_bulk': lambda: SalvarAtributosPontosServico(session=session).save_bulk(
+            {ps: {377: 'Centro'} for ps in ids_ps}, max_batch_bytes=4096
+        ),
+        'AtualizarObs.mudar_bulk': lambda: AtualizarObs(session=session).mudar_bulk(
+            [(Ocorrencia(ID_OCORRENCIA=ocorrencia), 'Benchmark') for ocorrencia in ids_ocorrencia], max_workers=4
+        ),
+        'SalvarExcluirOcorrencia.save': lambda: SalvarExcluirOcorrencia(session=session).save(
+            novas(), PrioridadeTipoOcorrencia(session=session), max_workers=4
+        ),
+        'SalvarExcluirOcorrencia.delete': lambda: SalvarExcluirOcorrencia(session=session).delete(
+            [Ocorrencia(ID_OCORRENCIA=ocorrencia, ID_SOLICITACAO=[ocorrencia * 10 + 1, ocorrencia * 10 + 2]) for ocorrencia in ids_ocorrencia],
+            max_workers=4
+        ),
+    }
+
+
+def run(size: int, latency: float, repeat: int, error_rate: float) -> list[dict]:
+    '''
+    Runs every benchmark, then ex_post with injected errors.
+    '''
+    results = []
+    with FakeExati(latency=latency, size=size) as server:
+        os.environ['EXATI_URL'] = server.url
+        with ExatiSession() as session:
+            for name, func in benchmarks(session, size).items():
+                results.append(measure(name, func, repeat))
+    with FakeExati(latency=latency, size=size, error_rate=error_rate) as server:
+        os.environ['EXATI_URL'] = server.url
+        with ExatiSession(retry=RetryPolicy(max_attempts=6, base_delay=0.001, max_delay=0.01)) as session:
+            payload = {'CMD_COMMAND': 'ConsultarAtributos', 'parser': 'json'}
+            results.append(measure(f'ex_post retries (error_rate={error_rate})', lambda: session.ex_post(payload, warnings=False), repeat * 5))
+            metrics = session.metrics.snapshot()['ConsultarAtributos']
+            results[-1]['attempts_per_call'] = metrics['attempts'] / metrics['calls']
+    return results
+
+
+def main():
+    '''
+    Prints a table with the results.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.3)
+    args = parser.parse_args()
+    os.environ.setdefault('EXATI_USER_PASS', 'benchmark:benchmark')
+    print(f'{"benchmark":<55} {"ops/s":>10} {"p50 ms":>10} {"p95 ms":>10}')
+    for result in run(args.size, args.latency, args.repeat, args.error_rate):
+        extra = f'  attempts/call = {result["attempts_per_call"]:.2f}' if 'attempts_per_call' in result else ''
+        print(f'{result["name"]:<55} {result["ops_s"]:>10.1f} {result["p50_ms"]:>10.2f} {result["p95_ms"]:>10.2f}{extra}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+'''
+Local stand-in for the Exati API, speaking the RAIZ/MESSAGES envelope over HTTP.
+'''
+
+import gzip
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs
+
+
+class FakeExati():
+    '''
+    Fake Exati server for the commands used by the routers.
+    latency -> seconds added to every answer.
+    error_rate -> fraction of requests answered with ERRORS, except Login.
+    size -> number of pontos de serviço in the dataset, other tables scale from it.
+    Answers are gzipped when the client accepts it. connections -> TCP connections opened by clients.
+    Usage: with FakeExati(size=1000) as server: os.environ['EXATI_URL'] = server.url
+    '''
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, size: int = 1000, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.size = size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens: set[str] = set()
+        self.logins = 0
+        self.connections = 0
+        self.requests: dict[str, int] = {}
+        self.dataset = self.build_dataset()
+        self.server: ThreadingHTTPServer = None
+        self.thread: threading.Thread = None
+
+    @property
+    def url(self) -> str:
+        '''
+        URL to use as EXATI_URL.
+        '''
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self) -> 'FakeExati':
+        '''
+        Serves in a background thread on a free local port.
+        '''
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            '''
+            Dispatches POST requests to FakeExati.answer.
+            '''
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections += 1
+
+            def do_POST(self):
+                '''
+                Answers an Exati command.
+                '''
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode(), keep_blank_values=True)
+                payload = {key: values[-1] for key, values in form.items()}
+                status, body = fake.answer(payload, self.headers.get('Authorization', ''))
+                data = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    data = gzip.compress(data, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops the server.
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_tokens(self):
+        '''
+        Rejects every token issued so far, as when JWTs expire mid-job.
+        '''
+        with self.lock:
+            self.tokens.clear()
+
+    def build_dataset(self) -> dict[str, list[dict]]:
+        '''
+        Deterministic tables sized from self.size.
+        '''
+        rng = self.random
+        today = datetime.today()
+        pontos = [{
+            'ID_PONTO_SERVICO': ps,
+            'LATITUDE_TOTAL': round(-10.95 + rng.random() * 0.1, 6),
+            'LONGITUDE_TOTAL': round(-37.10 + rng.random() * 0.1, 6),
+            'BAIRRO': rng.choice(('Jabotiana', 'Centro', 'Atalaia', 'Farolândia')),
+            'MARCO': f'M{ps:06d}',
+        } for ps in range(1, self.size + 1)]
+        ocorrencias = [{
+            'ID_OCORRENCIA': ocorrencia,
+            'ID_PONTO_SERVICO': rng.randint(1, self.size),
+            'ID_TIPO_OCORRENCIA': rng.randint(1, 10),
+            'DESC_TIPO_OCORRENCIA': 'Lâmpada apagada',
+            'DATA_OCORRENCIA': (today - timedelta(days=rng.randint(0, 120))).strftime('%d/%m/%Y'),
+            'DATA_ATENDIMENTO': (today - timedelta(days=rng.randint(0, 60))).strftime('%d/%m/%Y'),
+            'STATUS': rng.randint(0, 1),
+        } for ocorrencia in range(1, self.size // 2 + 1)]
+        laudos = [{
+            'ID_LAUDO': laudo,
+            'ID_TIPO_LAUDO': rng.randint(1, 7),
+            'ELABORADO': rng.randint(0, 1),
+            'ID_EQUIPE': rng.randint(1, 5),
+            'NUM_AMOSTRAS': 10,
+        } for laudo in range(1, self.size // 20 + 2)]
+        return {
+            'PONTO_SERVICO': pontos,
+            'OCORRENCIA': ocorrencias,
+            'LAUDO': laudos,
+            'ATRIBUTO': [{'ID_ATRIBUTO': 377, 'NOME': 'Bairro'}, {'ID_ATRIBUTO': 394, 'NOME': 'Marco'}],
+            'EQUIPE': [{'ID_EQUIPE': equipe, 'DESC_EQUIPE': f'Equipe {equipe}'} for equipe in range(1, 6)],
+            'TIPO_OCORRENCIA': [{'ID_TIPO_OCORRENCIA': tipo, 'DESC_TIPO_OCORRENCIA': f'Tipo {tipo}'} for tipo in range(1, 11)],
+        }
+
+    def answer(self, payload: dict, authorization: str) -> tuple[int, dict]:
+        '''
+        Returns HTTP status and body for a payload.
+        '''
+        command = payload.get('CMD_COMMAND', '')
+        with self.lock:
+            self.requests[command] = self.requests.get(command, 0) + 1
+            fail = command != 'Login' and self.random.random() < self.error_rate
+            authorized = authorization.startswith('Basic ') or authorization in self.tokens
+        if self.latency:
+            sleep(self.latency)
+        if command == 'Login':
+            with self.lock:
+                self.logins += 1
+                token = f'token-{self.logins}'
+                self.tokens.add(token)
+            return 200, self.envelope(AUTH_TOKEN=token)
+        if not authorized:
+            return 200, self.envelope(['Token inválido ou expirado.'])
+        if fail:
+            return 200, self.envelope(['Erro interno, tente novamente.'])
+        handler = getattr(self, f'command_{command}', None)
+        if handler is None:
+            return 200, self.envelope([f'Comando {command} não encontrado.'])
+        return 200, handler(payload)
+
+    @staticmethod
+    def envelope(errors: list = None, informations: list = None, **raiz) -> dict:
+        '''
+        Exati response envelope.
+        '''
+        return {'RAIZ': {'MESSAGES': {'ERRORS': errors or [], 'INFORMATIONS': informations or [], 'WARNINGS': []}, **raiz}}
+
+    def command_ConsultarAtributos(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ConsultarAtributos.
+        '''
+        return self.envelope(ATRIBUTOS={'ATRIBUTO': self.dataset['ATRIBUTO']})
+
+    def command_ConsultarEquipes(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ConsultarEquipes.
+        '''
+        return self.envelope(EQUIPES={'EQUIPE': self.dataset['EQUIPE']})
+
+    def command_ConsultarTipoOcorrencia(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ConsultarTipoOcorrencia.
+        '''
+        return self.envelope(TIPOS_OCORRENCIA={'TIPO_OCORRENCIA': self.dataset['TIPO_OCORRENCIA']})
+
+    def command_ConsultarPrioridadeTipoOcorrencia(self, payload: dict) -> dict:
+        '''
+        ConsultarPrioridadeTipoOcorrencia.
+        '''
+        sigla = 'A' if int(payload['CMD_ID_TIPO_OCORRENCIA']) % 2 else 'B'
+        return self.envelope(PRIORIDADES_TIPO_OCORRENCIA={'PRIORIDADE_TIPO_OCORRENCIA': [{'SIGLA_PRIORIDADE_PONTO_OCORR': sigla}]})
+
+    def command_ConsultarPontosServicos(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ConsultarPontosServicos.
+        '''
+        return self.envelope(PONTOS_SERVICOS={'PONTO_SERVICO': self.dataset['PONTO_SERVICO']})
+
+    def command_ConsultarStatusAtendimentoPontoServico(self, payload: dict) -> dict:
+        '''
+        ConsultarStatusAtendimentoPontoServico, filtered by date window and status.
+        '''
+        start = datetime.strptime(payload['CMD_DATA_INICIO'], '%d/%m/%Y')
+        end = datetime.strptime(payload['CMD_DATA_CONCLUSAO'], '%d/%m/%Y')
+        status = int(payload['CMD_STATUS'])
+        records = [
+            record for record in self.dataset['OCORRENCIA']
+            if start <= datetime.strptime(record['DATA_OCORRENCIA'], '%d/%m/%Y') <= end and status in (-1, record['STATUS'])
+        ]
+        return self.envelope(PONTOS_STATUS_ATENDIMENTO={'PONTO_STATUS_ATENDIMENTO': records})
+
+    def command_ConsultarAtendimentoPorPontoServico(self, payload: dict) -> dict:
+        '''
+        ConsultarAtendimentoPorPontoServico. Odd pontos have no atendimento.
+        '''
+        ps = int(payload['CMD_ID_PONTO_SERVICO'])
+        if ps % 2:
+            return self.envelope()
+        return self.envelope(ATENDIMENTOS={'ATENDIMENTO': [{
+            'DESC_STATUS_ATENDIMENTO_PS': 'Atendido',
+            'DESC_MOTIVO_ATENDIMENTO_PS': 'Troca de lâmpada',
+            'DATA_ATENDIMENTO': '02/01/2024',
+        }]})
+
+    def command_ConsultarSolicitacao(self, payload: dict) -> dict:
+        '''
+        ConsultarSolicitacao, paged with CMD_PAGE and CMD_PAGE_SIZE.
+        '''
+        size = int(payload.get('CMD_PAGE_SIZE', 5000))
+        page = int(payload.get('CMD_PAGE', 1))
+        records = [{'ID_SOLICITACAO': record['ID_OCORRENCIA'], **record} for record in self.dataset['OCORRENCIA']]
+        return self.envelope(TOTAL_REGISTROS=len(records), SOLICITACOES={'SOLICITACAO': records[(page - 1) * size:page * size]})
+
+    def command_ConsultarLaudo(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ConsultarLaudo.
+        '''
+        return self.envelope(LAUDOS={'LAUDO': self.dataset['LAUDO']})
+
+    def command_ConsultarAmostraLaudo(self, payload: dict) -> dict:
+        '''
+        ConsultarAmostraLaudo. Every other sample has two ocorrencias.
+        '''
+        laudo = int(payload['CMD_ID_LAUDO'])
+        return self.envelope(AMOSTRAS_LAUDO={'AMOSTRA_LAUDO': [
+            {'POSSUI_OCORRENCIA': 1, 'ID_OCORRENCIA': f'{laudo * 10 + sample}, {laudo * 10 + sample + 1}'} if sample % 2 else {'POSSUI_OCORRENCIA': 0}
+            for sample in range(10)
+        ]})
+
+    def command_ConsultarHistoricoVersaoPontoServico(self, payload: dict) -> dict:
+        '''
+        ConsultarHistoricoVersaoPontoServico. Three versions per ponto.
+        '''
+        ps = int(payload['CMD_ID_PONTO_SERVICO'])
+        return self.envelope(VERSOES={'VERSAO': [{'ID_ESTRUTURA_PS': ps * 10 + version} for version in range(3)]})
+
+    def command_ConsultarItensEstruturaPontoServico(self, payload: dict) -> dict:
+        '''
+        ConsultarItensEstruturaPontoServico.
+        '''
+        estrutura = int(payload['CMD_ID_ESTRUTURA_PS'])
+        return self.envelope(ITEM_ESTRUTURA_PS=[{'ID_ITEM': estrutura % 10 + item, 'QUANTIDADE': 1} for item in range(3)])
+
+    def command_ConsultarDetalhesSolicitacao(self, payload: dict) -> dict:
+        '''
+        ConsultarDetalhesSolicitacao. Solicitacoes multiple of 7 have reabertura.
+        '''
+        return self.envelope(SOLICITACAO={'POSSUI_ATENDIMENTO_ANTERIOR': int(int(payload['CMD_ID_SOLICITACAO']) % 7 == 0)})
+
+    def command_ConsultarPontosServicoOcorrenciaNovo(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ConsultarPontosServicoOcorrenciaNovo.
+        '''
+        return self.envelope(PONTOS_SERVICOS_OCORRENCIA={'PONTO_SERVICO_OCORRENCIA': [{}]})
+
+    def command_SalvarSolicitacaoPontoServico(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        SalvarSolicitacaoPontoServico.
+        '''
+        return self.envelope(informations=['Solicitação salva com sucesso.'])
+
+    def command_CancelarElaboracaoSolicitacao(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        CancelarElaboracaoSolicitacao.
+        '''
+        return self.envelope(informations=['Elaboração cancelada.'])
+
+    def command_ExcluirSolicitacao(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        ExcluirSolicitacao.
+        '''
+        return self.envelope(informations=['Solicitação excluída.'])
+
+    def command_AtualizarObsPontoOcorrencia(self, payload: dict) -> dict:  # pylint: disable=unused-argument
+        '''
+        AtualizarObsPontoOcorrencia.
+        '''
+        return self.envelope(informations=['Observação atualizada.'])
+
+    def command_SalvarAtributosPontosServico(self, payload: dict) -> dict:
+        '''
+        SalvarAtributosPontosServico.
+        '''
+        records = json.loads(payload['CMD_ATRIBUTOS'])
+        return self.envelope(informations=[f'{len(records)} atributos salvos.'])
@@ -0,0 +1,76 @@
+'''
+Fake Exati session used by the offline tests.
+'''
+
+import os
+import json
+import threading
+from time import sleep
+
+from exati import ExatiSession
+
+os.environ.setdefault('EXATI_USER_PASS', 'teste:teste')
+
+
+class FakeResponse():
+    '''
+    Minimal requests.Response stand-in.
+    '''
+    def __init__(self, body: dict, status_code: int = 200):
+        self.body = body
+        self.status_code = status_code
+        self.content = json.dumps(body).encode()
+
+    def json(self) -> dict:
+        '''
+        Returns response body.
+        '''
+        return self.body
+
+
+class FakeSession(ExatiSession):
+    '''
+    ExatiSession answering from a callable instead of the network.
+    Login requests are answered with a new token each time and counted in logins.
+    '''
+    def __init__(self, answer, delay: float = 0, **kwargs):
+        self.answer = answer
+        self.delay = delay
+        self.logins = 0
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def post(self, url=None, data=None, **kwargs):  # pylint: disable=arguments-differ
+        if data['CMD_COMMAND'] == 'Login':
+            with self.lock:
+                self.logins += 1
+                return FakeResponse(envelope(AUTH_TOKEN=f'token-{self.logins}'))
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return FakeResponse(self.answer(data))
+
+
+def envelope(errors: list = None, **raiz) -> dict:
+    '''
+    Builds an Exati response envelope.
+    '''
+    return {'RAIZ': {'MESSAGES': {'ERRORS': errors or [], 'INFORMATIONS': []}, **raiz}}
+
+
+def atendimento(payload: dict) -> dict:
+    '''
+    Answer for ConsultarAtendimentoPorPontoServico.
+    '''
+    return envelope(ATENDIMENTOS={'ATENDIMENTO': [{
+        'DESC_STATUS_ATENDIMENTO_PS': 'Atendido',
+        'DESC_MOTIVO_ATENDIMENTO_PS': str(payload['CMD_ID_PONTO_SERVICO']),
+        'DATA_ATENDIMENTO': '02/01/2024'
+    }]})
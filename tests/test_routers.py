@@ -2,10 +2,19 @@
 Tests class ConsultarAtributo
 '''
 
+import io
+import json
 from datetime import datetime, timedelta
+from time import monotonic
+
+import pytest
 
 from exati import ExatiSession, ConsultarAtributos, IDsParqueServico, AtendimentosPendentesRealizados
-from exati import AtendimentoPorPontoServico, ConsultarEquipes, ConsultarLaudo
+from exati import AtendimentoPorPontoServico, ConsultarEquipes, ConsultarLaudo, ResponseCache
+from exati import Ocorrencia, PrioridadeTipoOcorrencia, ConsultarSolicitacao, PontosServico, AtendimentosStore
+from exati import Laudo, ConsultarAmostraLaudo, ConsultarHistoricoPontoServico, SalvarAtributosPontosServico
+from exati import SalvarExcluirOcorrencia, write_csv, write_ndjson, Journal, AtualizarObs
+from tests.fakes import FakeSession, atendimento, envelope
 
 
 def test_attribute_name():
@@ -84,3 +93,379 @@ def test_consultar_laudo():
         records = laudos.export(ID_TIPO_LAUDO=(5, 7), ELABORADO=(1,))
         print([(atb['ID_TIPO_LAUDO'], atb['ELABORADO']) for atb in records])
         assert 'ID_LAUDO' in records[0]
+
+
+def test_batch_status_motivo_date():
+    '''
+    Batch lookup keeps per item fallback and failures don't abort the batch.
+    '''
+    def answer(payload: dict) -> dict:
+        if payload['CMD_ID_PONTO_SERVICO'] == 2:
+            return {'RAIZ': {'MESSAGES': {'ERRORS': [], 'INFORMATIONS': []}}}
+        if payload['CMD_ID_PONTO_SERVICO'] == 3:
+            raise ConnectionError('ps 3')
+        return atendimento(payload)
+
+    atendimento_ps = AtendimentoPorPontoServico(session=FakeSession(answer))
+    result = atendimento_ps.batch_status_motivo_date(range(1, 6), max_workers=4)
+    assert sorted(result) == [1, 2, 4, 5]
+    assert result[1] == ('Atendido', '1', datetime(2024, 1, 2))
+    assert result[2] == ('Pendente', 'Pendente', datetime(2021, 7, 1))
+    assert isinstance(atendimento_ps.errors[3], ConnectionError)
+
+
+def test_reference_data_cache(tmp_path):
+    '''
+    Reference tables are served from ResponseCache until invalidated.
+    '''
+    session = FakeSession(lambda payload: envelope(ATRIBUTOS={'ATRIBUTO': [{'NOME': 'Bairro', 'ID_ATRIBUTO': 1}]}))
+    path = str(tmp_path / 'responses.sqlite')
+    attributes = ConsultarAtributos(session=session, cache=ResponseCache(path=path))
+    assert 'Bairro' in attributes.name_to_records()
+    assert 1 in attributes.name_to_records(name='ID_ATRIBUTO')
+    assert 'Bairro' in ConsultarAtributos(session=session, cache=ResponseCache(path=path)).name_to_records()
+    assert session.calls == 1
+    cache = ResponseCache(path=path)
+    cache.invalidate('ConsultarAtributos')
+    ConsultarAtributos(session=session, cache=cache).export()
+    assert session.calls == 2
+
+
+def test_prioridade_prefetch(tmp_path):
+    '''
+    Priorities of every tipo are prefetched and shared through ResponseCache.
+    '''
+    def answer(payload: dict) -> dict:
+        if payload['CMD_COMMAND'] == 'ConsultarTipoOcorrencia':
+            return envelope(TIPOS_OCORRENCIA={'TIPO_OCORRENCIA': [{'ID_TIPO_OCORRENCIA': tipo} for tipo in range(5)]})
+        sigla = f"P{payload['CMD_ID_TIPO_OCORRENCIA']}"
+        return envelope(PRIORIDADES_TIPO_OCORRENCIA={'PRIORIDADE_TIPO_OCORRENCIA': [{'SIGLA_PRIORIDADE_PONTO_OCORR': sigla}]})
+
+    session = FakeSession(answer)
+    cache = ResponseCache(path=str(tmp_path / 'responses.sqlite'))
+    assert PrioridadeTipoOcorrencia(session=session, cache=cache).prefetch() == {tipo: f'P{tipo}' for tipo in range(5)}
+    assert session.calls == 1 + 5
+    ocorrencia = Ocorrencia(ID_TIPO_OCORRENCIA=3)
+    PrioridadeTipoOcorrencia(session=session, cache=cache).add_priority(ocorrencia)
+    assert ocorrencia.SIGLA_PRIORIDADE_PONTO_OCORR == 'P3'
+    assert session.calls == 1 + 5
+
+
+def test_consultar_solicitacao_pages():
+    '''
+    Every page is walked until a short page.
+    '''
+    def answer(payload: dict) -> dict:
+        start = (payload['CMD_PAGE'] - 1) * payload['CMD_PAGE_SIZE']
+        ids = range(start, min(start + payload['CMD_PAGE_SIZE'], 25))
+        return envelope(SOLICITACOES={'SOLICITACAO': [{'ID_SOLICITACAO': id_solicitacao} for id_solicitacao in ids]})
+
+    session = FakeSession(answer)
+    solicitacoes = ConsultarSolicitacao(session=session)
+    records = solicitacoes.export(datetime(2024, 1, 1), page_size=10)
+    assert [record['ID_SOLICITACAO'] for record in records] == list(range(25))
+    assert session.calls == 3
+
+
+def test_consultar_solicitacao_server_ignores_pages():
+    '''
+    A server that answers the first page for every CMD_PAGE stops after the repeated page, MAX_PAGES bounds the rest.
+    '''
+    def answer(_payload: dict) -> dict:
+        return envelope(SOLICITACOES={'SOLICITACAO': [{'ID_SOLICITACAO': id_solicitacao} for id_solicitacao in range(10)]})
+
+    session = FakeSession(answer)
+    records = ConsultarSolicitacao(session=session).export(datetime(2024, 1, 1), page_size=10)
+    assert [record['ID_SOLICITACAO'] for record in records] == list(range(10))
+    assert session.calls == 2
+
+    def growing(_payload: dict) -> dict:
+        start = session.calls * 10
+        return envelope(SOLICITACOES={'SOLICITACAO': [{'ID_SOLICITACAO': id_solicitacao} for id_solicitacao in range(start, start + 10)]})
+
+    session = FakeSession(growing)
+    solicitacoes = ConsultarSolicitacao(session=session)
+    solicitacoes.MAX_PAGES = 5
+    assert len(solicitacoes.export(datetime(2024, 1, 1), page_size=10)) == 50
+    assert session.calls == 5
+
+
+def test_consultar_solicitacao_sharded_without_end_date():
+    '''
+    A server that ignores the end date answers every record from the start date on, slices keep only their own days.
+    '''
+    solicitacoes = [
+        {'ID_SOLICITACAO': day, 'DATA_RECLAMACAO': (datetime(2024, 1, 1) + timedelta(days=day)).strftime('%d/%m/%Y')} for day in range(60)
+    ]
+
+    def answer(payload: dict) -> dict:
+        start = datetime.strptime(payload['CMD_DATA_RECLAMACAO'], '%d/%m/%Y')
+        records = [record for record in solicitacoes if datetime.strptime(record['DATA_RECLAMACAO'], '%d/%m/%Y') >= start]
+        return envelope(SOLICITACOES={'SOLICITACAO': records})
+
+    session = FakeSession(answer)
+    records = ConsultarSolicitacao(session=session).export_sharded(datetime(2024, 1, 1), datetime(2024, 2, 29), slice_days=10, max_rows=15)
+    assert [record['ID_SOLICITACAO'] for record in records] == list(range(60))
+    assert session.calls == 6
+
+
+def test_pontos_servico_spatial_queries():
+    '''
+    Grid index answers match a brute force scan.
+    '''
+    records = [
+        {'ID_PONTO_SERVICO': i * 100 + j, 'LATITUDE_TOTAL': f'-10,9{i:02d}', 'LONGITUDE_TOTAL': -37.05 + j * 0.0013}
+        for i in range(40) for j in range(40)
+    ]
+    pontos = PontosServico.from_records(records + [{'ID_PONTO_SERVICO': 1}])
+    assert len(pontos) == 1600
+    assert pontos[101].LATITUDE_TOTAL == -10.901
+    brute = sorted(((ps.ID_PONTO_SERVICO, pontos.distance(-10.92, -37.03, ps.LATITUDE_TOTAL, ps.LONGITUDE_TOTAL)) for ps in pontos), key=lambda item: item[1])
+    assert pontos.nearest(-10.92, -37.03, k=5) == brute[:5]
+    for latitude, longitude in ((0, 0), (-13.9, -40.0), (-10.92, -34.0)):
+        start = monotonic()
+        far = sorted(((ps.ID_PONTO_SERVICO, pontos.distance(latitude, longitude, ps.LATITUDE_TOTAL, ps.LONGITUDE_TOTAL)) for ps in pontos), key=lambda item: item[1])
+        assert pontos.nearest(latitude, longitude, k=3) == far[:3]
+        assert monotonic() - start < 1
+    assert pontos.radius(-10.92, -37.03, 400) == [item for item in brute if item[1] <= 400]
+    assert sorted(pontos.bbox(-10.905, -37.05, -10.9, -37.04)) == sorted(
+        ps.ID_PONTO_SERVICO for ps in pontos if -10.905 <= ps.LATITUDE_TOTAL <= -10.9 and -37.05 <= ps.LONGITUDE_TOTAL <= -37.04
+    )
+
+
+def test_atendimentos_sync(tmp_path):
+    '''
+    Sync returns only new or changed records and moves the window to the watermark.
+    '''
+    rows = [{'ID_OCORRENCIA': 1, 'DATA_OCORRENCIA': '01/01/2024'}, {'ID_OCORRENCIA': 2, 'DATA_OCORRENCIA': '02/01/2024'}]
+    payloads = []
+
+    def answer(payload: dict) -> dict:
+        payloads.append(payload)
+        return envelope(PONTOS_STATUS_ATENDIMENTO={'PONTO_STATUS_ATENDIMENTO': [dict(row) for row in rows]})
+
+    store = AtendimentosStore(path=str(tmp_path / 'atendimentos.sqlite'))
+    pendentes = AtendimentosPendentesRealizados(session=FakeSession(answer))
+    assert len(pendentes.sync(store, status=0)) == 2
+    assert not pendentes.sync(store, status=0)
+    rows[1]['DATA_OCORRENCIA'] = '03/01/2024'
+    assert pendentes.sync(store, status=0) == [rows[1]]
+    expected = (datetime.today() - timedelta(days=2)).strftime('%d/%m/%Y')
+    assert payloads[-1]['CMD_DATA_INICIO'] == expected
+    assert len(store.records(0)) == 2
+
+
+def test_export_sharded_splits_and_dedups():
+    '''
+    Slices with too many rows are split and records on slice borders are not repeated.
+    '''
+    days = {f'{day:02d}/01/2024': [{'ID_OCORRENCIA': day}, {'ID_OCORRENCIA': day + 1}] for day in range(1, 31)}
+    windows = []
+
+    def answer(payload: dict) -> dict:
+        start = datetime.strptime(payload['CMD_DATA_INICIO'], '%d/%m/%Y')
+        end = datetime.strptime(payload['CMD_DATA_CONCLUSAO'], '%d/%m/%Y')
+        windows.append((start.day, end.day))
+        records = [record for day in range((end - start).days + 1) for record in days[(start + timedelta(days=day)).strftime('%d/%m/%Y')]]
+        return envelope(PONTOS_STATUS_ATENDIMENTO={'PONTO_STATUS_ATENDIMENTO': records})
+
+    pendentes = AtendimentosPendentesRealizados(session=FakeSession(answer))
+    records = pendentes.export_sharded('01/01/2024', '30/01/2024', status=0, slice_days=10, max_rows=8)
+    assert [record['ID_OCORRENCIA'] for record in records] == list(range(1, 32))
+    assert (1, 10) in windows and (1, 5) in windows and (1, 3) in windows
+
+
+def test_consultar_laudo_indexes():
+    '''
+    Queries with different filters over the same window reuse one download.
+    '''
+    laudos = [{'ID_LAUDO': i, 'ID_TIPO_LAUDO': i % 3, 'ELABORADO': i % 2, 'ID_EQUIPE': i % 5, 'NUM_AMOSTRAS': i} for i in range(60)]
+    session = FakeSession(lambda payload: envelope(LAUDOS={'LAUDO': laudos}))
+    router = ConsultarLaudo(session=session)
+    records = router.export(ID_TIPO_LAUDO=(0, 1), ELABORADO=(1,), NUM_AMOSTRAS=tuple(range(30)))
+    assert records == [laudo for laudo in laudos if laudo['ID_TIPO_LAUDO'] in (0, 1) and laudo['ELABORADO'] == 1 and laudo['NUM_AMOSTRAS'] < 30]
+    assert router.export(ID_EQUIPE=(2,)) == [laudo for laudo in laudos if laudo['ID_EQUIPE'] == 2]
+    assert session.calls == 1
+    router.export(refresh=True)
+    assert session.calls == 2
+
+
+def test_consultar_laudo_data_final():
+    '''
+    Laudos after data_final are dropped even when the server ignores CMD_DATA_CRIACAO_FINAL.
+    '''
+    laudos = [{'ID_LAUDO': day, 'DATA': f'{day:02d}/03/2024'} for day in range(1, 31)]
+    router = ConsultarLaudo(session=FakeSession(lambda payload: envelope(LAUDOS={'LAUDO': laudos})))
+    records = router.export(datetime(2024, 3, 1), datetime(2024, 3, 10))
+    assert [laudo['ID_LAUDO'] for laudo in records] == list(range(1, 11))
+
+
+def test_fill_laudos():
+    '''
+    Every laudo gets its ocorrencias, and a failed laudo doesn't stop the others.
+    '''
+    def answer(payload: dict) -> dict:
+        if payload['CMD_ID_LAUDO'] == 3:
+            raise ConnectionError('laudo 3')
+        return envelope(AMOSTRAS_LAUDO={'AMOSTRA_LAUDO': [
+            {'POSSUI_OCORRENCIA': 1, 'ID_OCORRENCIA': f"{payload['CMD_ID_LAUDO']}0, {payload['CMD_ID_LAUDO']}1"},
+            {'POSSUI_OCORRENCIA': 0},
+        ]})
+
+    ids_to_ocorrencia = {10: {'ID_OCORRENCIA': 10, 'ID_PONTO_SERVICO': 7, 'DESC_TIPO_OCORRENCIA': 'Apagada'}}
+    laudos = ConsultarAmostraLaudo(session=FakeSession(answer)).fill_laudos([Laudo(ID_LAUDO=i) for i in range(1, 5)], ids_to_ocorrencia)
+    assert [laudo.NUM_OCORRENCIAS for laudo in laudos] == [2, 2, None, 2]
+    assert laudos[2].RESULTADO == 'NOK'
+    assert laudos[0].OCORRENCIAS[0].ID_PONTO_SERVICO == 7
+
+
+def test_historico_versions_cache(tmp_path):
+    '''
+    Structure items are cached by ID_ESTRUTURA_PS and consecutive versions are diffed.
+    '''
+    def answer(payload: dict) -> dict:
+        if payload['CMD_COMMAND'] == 'ConsultarHistoricoVersaoPontoServico':
+            return envelope(VERSOES={'VERSAO': [{'ID_ESTRUTURA_PS': 1}, {'ID_ESTRUTURA_PS': 2}]})
+        items = [{'ID_ITEM': 10}] if payload['CMD_ID_ESTRUTURA_PS'] == 1 else [{'ID_ITEM': 11}]
+        return envelope(ITEM_ESTRUTURA_PS=items)
+
+    session = FakeSession(answer)
+    cache = ResponseCache(path=str(tmp_path / 'responses.sqlite'))
+    historico = ConsultarHistoricoPontoServico(session=session, cache=cache)
+    versions = historico.export_versions(ps=68582)
+    assert [version['ITENS'] for version in versions] == [[{'ID_ITEM': 10}], [{'ID_ITEM': 11}]]
+    assert historico.diff_versions(versions)[0]['ADICIONADOS'] == [{'ID_ITEM': 11}]
+    assert historico.diff_versions(versions)[0]['REMOVIDOS'] == [{'ID_ITEM': 10}]
+    ConsultarHistoricoPontoServico(session=session, cache=ResponseCache(path=cache.path)).export_versions(ps=68582)
+    assert session.calls == 3 + 1
+
+
+def test_save_bulk_atributos():
+    '''
+    Points are packed in size bounded JSON batches, rejected batches are split until only the invalid point is NOK.
+    '''
+    batches = []
+
+    def answer(payload: dict) -> dict:
+        records = json.loads(payload['CMD_ATRIBUTOS'])
+        batches.append(len(payload['CMD_ATRIBUTOS']))
+        if any(record['ID_PONTO_SERVICO'] == 0 for record in records):
+            return envelope(['Valor inválido'])
+        return {'RAIZ': {'MESSAGES': {'ERRORS': [], 'INFORMATIONS': ['Salvo']}}}
+
+    router = SalvarAtributosPontosServico(session=FakeSession(answer))
+    results = router.save_bulk({ps: {377: 'Jabotiana', 394: 'Sim'} for ps in range(100)}, max_batch_bytes=2000)
+    assert len(results) == 100
+    assert max(batches) <= 2000 and len(batches) > 1
+    assert [ps for ps, result in results.items() if result['RESULTADO'] == 'NOK'] == [0]
+    assert results[0]['MENSAGEM'] == 'Erro: Valor inválido'
+
+
+def test_delete_ocorrencias_in_parallel():
+    '''
+    Parallel delete keeps RESULTADO and MENSAGEM of each Ocorrencia.
+    '''
+    def answer(payload: dict) -> dict:
+        if payload['CMD_COMMAND'] == 'ConsultarDetalhesSolicitacao':
+            return envelope(SOLICITACAO={'POSSUI_ATENDIMENTO_ANTERIOR': int(payload['CMD_ID_SOLICITACAO'] == 21)})
+        if payload['CMD_COMMAND'] == 'ConsultarPontosServicoOcorrenciaNovo':
+            record = {'ID_REPROGRAMACAO_ATUAL': 1} if payload['CMD_ID_OCORRENCIA'] == 3 else {}
+            return envelope(PONTOS_SERVICOS_OCORRENCIA={'PONTO_SERVICO_OCORRENCIA': [record]})
+        if payload['CMD_ID_SOLICITACAO'] == 40:
+            raise ConnectionError('solicitacao 40')
+        return {'RAIZ': {'MESSAGES': {'ERRORS': [], 'INFORMATIONS': ['Excluída']}}}
+
+    session = FakeSession(answer, delay=0.01)
+    ocorrencias = [Ocorrencia(ID_OCORRENCIA=i, ID_SOLICITACAO=[i * 10, i * 10 + 1]) for i in range(1, 5)]
+    SalvarExcluirOcorrencia(session=session).delete(ocorrencias, max_workers=4)
+    assert [ocorrencia.RESULTADO for ocorrencia in ocorrencias] == ['OK', 'NOK', 'NOK', 'NOK']
+    assert ocorrencias[1].MENSAGEM.startswith('Solicitação possui reabertura')
+    assert ocorrencias[2].MENSAGEM.startswith('Ocorrência possui reabertura')
+    assert 'solicitacao 40' in ocorrencias[3].MENSAGEM
+    assert 1 < session.max_in_flight <= 4
+
+    session = FakeSession(answer, delay=0.01)
+    ocorrencias = [Ocorrencia(ID_OCORRENCIA=i, ID_SOLICITACAO=[i * 100 + j for j in range(5)]) for i in range(4, 10)]
+    SalvarExcluirOcorrencia(session=session).delete(ocorrencias, max_workers=2)
+    assert all(ocorrencia.RESULTADO == 'OK' for ocorrencia in ocorrencias)
+    assert session.max_in_flight == 2
+
+
+def test_models_writers():
+    '''
+    Slotted models build from records and stream to CSV and NDJSON.
+    '''
+    ocorrencia = Ocorrencia.from_record({'ID_OCORRENCIA': 1, 'ID_SOLICITACAO': [10, 11], 'OUTRA_CHAVE': 'x'})
+    assert ocorrencia.ID_SOLICITACAO == [10, 11]
+    assert not hasattr(ocorrencia, '__dict__')
+    assert ocorrencia.header()[:3] == ['ID_PONTO_SERVICO', 'ID_SOLICITACAO', 'ID_OCORRENCIA']
+    csv_file = io.StringIO()
+    write_csv([ocorrencia, Ocorrencia(ID_OCORRENCIA=2)], csv_file)
+    lines = csv_file.getvalue().splitlines()
+    assert len(lines) == 3 and lines[0].startswith('ID_PONTO_SERVICO;ID_SOLICITACAO')
+    ndjson_file = io.StringIO()
+    write_ndjson([Laudo(ID_LAUDO=5, OCORRENCIAS=[ocorrencia])], ndjson_file)
+    assert json.loads(ndjson_file.getvalue())['OCORRENCIAS'][0]['ID_OCORRENCIA'] == 1
+
+
+def test_journal_resumes_bulk_jobs(tmp_path):
+    '''
+    Interrupted bulk jobs go on from the journal without sending done, or in doubt, items again.
+    '''
+    sent = []
+    failing = {'ps': 3, 'batch': 0}
+
+    def answer(payload: dict) -> dict:
+        if payload['CMD_COMMAND'] == 'ConsultarPrioridadeTipoOcorrencia':
+            return envelope(PRIORIDADES_TIPO_OCORRENCIA={'PRIORIDADE_TIPO_OCORRENCIA': [{'SIGLA_PRIORIDADE_PONTO_OCORR': 'A'}]})
+        if payload['CMD_COMMAND'] == 'SalvarAtributosPontosServico':
+            ids_ps = [record['ID_PONTO_SERVICO'] for record in json.loads(payload['CMD_ATRIBUTOS'])]
+            sent.append(ids_ps)
+            if failing['batch'] in ids_ps:
+                raise ConnectionError('batch')
+        else:
+            sent.append(payload.get('CMD_ID_PONTO_SERVICO', payload.get('CMD_ID_OCORRENCIA')))
+            if payload.get('CMD_ID_PONTO_SERVICO') == failing['ps']:
+                raise KeyboardInterrupt
+        return {'RAIZ': {'MESSAGES': {'ERRORS': [], 'INFORMATIONS': ['Salvo']}}}
+
+    def novas() -> list[Ocorrencia]:
+        return [Ocorrencia(ID_PONTO_SERVICO=ps, DATA_RECLAMACAO='02/01/2024', HORA_RECLAMACAO='10:00',
+                           ID_TIPO_OCORRENCIA=1, ID_TIPO_ORIGEM_OCORRENCIA=2) for ps in range(1, 6)]
+
+    session = FakeSession(answer)
+    path = str(tmp_path / 'journal.ndjson')
+    ocorrencias = novas()
+    with Journal(path) as journal, pytest.raises(KeyboardInterrupt):
+        SalvarExcluirOcorrencia(session=session).save(ocorrencias, PrioridadeTipoOcorrencia(session=session), journal=journal)
+    assert sent == [1, 2, 3]
+    failing['ps'] = 0
+    # The rerun gets the same objects, already changed by the first run.
+    with Journal(path) as journal:
+        SalvarExcluirOcorrencia(session=session).save(ocorrencias, PrioridadeTipoOcorrencia(session=session), journal=journal)
+    assert sent == [1, 2, 3, 4, 5]
+    assert [ocorrencia.RESULTADO for ocorrencia in ocorrencias] == ['OK', 'OK', 'NOK', 'OK', 'OK']
+    assert ocorrencias[2].MENSAGEM == SalvarExcluirOcorrencia.IN_DOUBT
+    with Journal(path) as journal:
+        SalvarExcluirOcorrencia(session=session).save(novas(), PrioridadeTipoOcorrencia(session=session), journal=journal)
+    assert sent == [1, 2, 3, 4, 5]
+
+    sent.clear()
+    pontos = {ps: {377: 'Centro'} for ps in range(20)}
+    with Journal(path) as journal:
+        first = SalvarAtributosPontosServico(session=session).save_bulk(pontos, max_batch_bytes=600, journal=journal)
+    failed = [ids_ps for ids_ps in sent if 0 in ids_ps][0]
+    assert first[0]['RESULTADO'] == 'NOK' and len(sent) > 1
+    sent.clear()
+    failing['batch'] = -1
+    with Journal(path) as journal:
+        second = SalvarAtributosPontosServico(session=session).save_bulk(pontos, max_batch_bytes=600, journal=journal)
+    assert sent == [failed]
+    assert all(result['RESULTADO'] == 'OK' for result in second.values())
+
+    sent.clear()
+    for _ in range(2):
+        with Journal(path) as journal:
+            AtualizarObs(session=session).mudar_bulk([(ocorrencia, 'Nova obs') for ocorrencia in ocorrencias], journal=journal)
+    assert len(sent) == 5
+    assert all(ocorrencia.OBS == 'Nova obs' and ocorrencia.RESULTADO == 'OK' for ocorrencia in ocorrencias)
@@ -0,0 +1,335 @@
+'''
+Tests ExatiSession and its helpers without the live Exati API.
+'''
+
+import os
+import json
+import socket
+import asyncio
+import threading
+from time import monotonic, sleep
+
+import pytest
+import requests
+
+from exati import AsyncExatiSession, AtendimentoPorPontoServico, RetryPolicy, TokenCache, iter_json_array
+from exati import ExatiSession, ConsultarAtributos, IDsParqueServico, Cassette, SingleFlight, map_concurrently, RateLimiter
+from exati import Hedging, deadline, ExatiSessionPool, ExatiError
+from tests.fakes import FakeSession, atendimento, envelope
+from tests.fake_exati import FakeExati
+
+
+def test_async_session_limits_in_flight():
+    '''
+    AsyncExatiSession never exceeds max_in_flight and keeps result order.
+    '''
+    session = FakeSession(atendimento, delay=0.02)
+
+    async def main():
+        async with AsyncExatiSession(session=session, max_in_flight=3) as async_session:
+            return await async_session.gather(AtendimentoPorPontoServico, [{'ps': ps} for ps in range(12)])
+
+    results = asyncio.run(main())
+    assert [records[0]['DESC_MOTIVO_ATENDIMENTO_PS'] for records in results] == [str(ps) for ps in range(12)]
+    assert session.max_in_flight <= 3
+    assert session.calls == 12
+
+
+def test_retry_policy_bounds_attempts():
+    '''
+    ex_post loops with a bounded number of attempts and stops on non retryable errors.
+    '''
+    retry = RetryPolicy(max_attempts=3, base_delay=0)
+    broken = FakeSession(lambda payload: {'ERRO': 'sem RAIZ'}, retry=retry)
+    assert broken.ex_post({'CMD_COMMAND': 'Teste'}, warnings=False) == {'ERRO': 'sem RAIZ'}
+    assert broken.calls == 3
+
+    busy = FakeSession(lambda payload: envelope(['Servidor ocupado']), retry=retry)
+    busy.ex_post({'CMD_COMMAND': 'Teste'}, warnings=False)
+    assert busy.calls == 3
+
+    invalid = FakeSession(lambda payload: envelope(['Necessário informar o ponto']), retry=retry)
+    invalid.ex_post({'CMD_COMMAND': 'Teste'}, warnings=False)
+    assert invalid.calls == 1
+
+    def raising(payload: dict) -> dict:
+        raise TypeError('fora da resposta')
+
+    failing = FakeSession(raising, retry=retry)
+    with pytest.raises(TypeError):
+        failing.ex_post({'CMD_COMMAND': 'Teste'}, warnings=False)
+    assert failing.calls == 1
+
+
+def test_retry_policy_delay_is_capped():
+    '''
+    Backoff grows exponentially with jitter and never passes max_delay.
+    '''
+    retry = RetryPolicy(base_delay=1, max_delay=5)
+    assert all(0 <= retry.delay(1) <= 1 for _ in range(100))
+    assert all(0 <= retry.delay(10) <= 5 for _ in range(100))
+
+
+def test_token_cache_skips_login(tmp_path):
+    '''
+    A cached token is reused by new sessions and replaced when Exati rejects it.
+    '''
+    cache = TokenCache(path=str(tmp_path / 'tokens' / 'tokens.sqlite'))
+    assert os.stat(cache.path).st_mode & 0o777 == 0o600
+    assert os.stat(tmp_path / 'tokens').st_mode & 0o777 == 0o700
+    # A directory made by another process is used as it is.
+    (tmp_path / 'shared').mkdir()
+    os.chmod(tmp_path / 'shared', 0o755)
+    TokenCache(path=str(tmp_path / 'shared' / 'tokens.sqlite'))
+    assert os.stat(tmp_path / 'shared').st_mode & 0o777 == 0o755
+    first = FakeSession(atendimento, token_cache=cache)
+    assert first.logins == 1
+    second = FakeSession(atendimento, token_cache=cache)
+    assert second.logins == 0
+    assert second.headers['Authorization'] == 'token-1'
+
+    cache.invalidate(second.token_key)
+
+    def answer(payload: dict) -> dict:
+        if rejecting.headers['Authorization'] == 'token-1':
+            return envelope(['Token expirado'])
+        return atendimento(payload)
+
+    rejecting = FakeSession(answer, token_cache=cache)
+    rejecting.headers['Authorization'] = 'token-1'
+    response = rejecting.ex_post({'CMD_COMMAND': 'ConsultarAtendimentoPorPontoServico', 'CMD_ID_PONTO_SERVICO': 1}, warnings=False)
+    assert 'ATENDIMENTOS' in response['RAIZ']
+    assert rejecting.logins == 2
+    assert cache.get(rejecting.token_key) == rejecting.headers['Authorization']
+
+
+def test_iter_json_array_small_chunks():
+    '''
+    Records are decoded across chunk boundaries, including multibyte characters, and projected.
+    '''
+    records = [{'ID_PONTO_SERVICO': ps, 'BAIRRO': 'São José', 'MARCO': f'M{ps}'} for ps in range(50)]
+    body = json.dumps(envelope(PONTOS_SERVICOS={'PONTO_SERVICO': records}), ensure_ascii=False).encode()
+    chunks = (body[start:start + 7] for start in range(0, len(body), 7))
+    parsed = list(iter_json_array(chunks, 'PONTO_SERVICO', fields=('ID_PONTO_SERVICO', 'BAIRRO')))
+    assert parsed == [{'ID_PONTO_SERVICO': ps, 'BAIRRO': 'São José'} for ps in range(50)]
+
+
+def test_metrics_and_hooks(tmp_path):
+    '''
+    ex_post feeds metrics by command and calls start and end hooks.
+    '''
+    session = FakeSession(lambda payload: envelope(['Servidor ocupado']) if payload['CMD_ID_PONTO_SERVICO'] == 0 else atendimento(payload),
+                          retry=RetryPolicy(max_attempts=2, base_delay=0))
+    started, ended = [], []
+    session.on_request_start.append(started.append)
+    session.on_request_end.append(ended.append)
+    for ps in range(3):
+        session.ex_post({'CMD_COMMAND': 'ConsultarAtendimentoPorPontoServico', 'CMD_ID_PONTO_SERVICO': ps}, warnings=False)
+    metrics = session.metrics.snapshot()['ConsultarAtendimentoPorPontoServico']
+    assert metrics['calls'] == 3 and metrics['attempts'] == 4 and metrics['max_attempts'] == 2
+    assert metrics['errors'] == {'ERRORS': 1}
+    assert metrics['bytes'] > 0
+    assert len(started) == len(ended) == 3 and ended[0].seconds is not None
+    assert 'exati_requests_total{command="ConsultarAtendimentoPorPontoServico"} 3' in session.metrics.to_prometheus()
+    session.metrics.write_json(str(tmp_path / 'metrics.json'))
+    assert json.loads((tmp_path / 'metrics.json').read_text())['commands']['ConsultarAtendimentoPorPontoServico']['calls'] == 3
+
+
+def test_metrics_prometheus_families():
+    '''
+    Each metric family is one group in the Prometheus text: its TYPE line, then all of its samples.
+    '''
+    def answer(payload: dict) -> dict:
+        if payload['CMD_COMMAND'] == 'ConsultarAtendimentoPorPontoServico':
+            return atendimento(payload)
+        return envelope(['Falhou'])
+
+    session = FakeSession(answer, retry=RetryPolicy(max_attempts=1))
+    session.ex_post({'CMD_COMMAND': 'ConsultarAtendimentoPorPontoServico', 'CMD_ID_PONTO_SERVICO': 1}, warnings=False)
+    session.ex_post({'CMD_COMMAND': 'ConsultarEquipes'}, warnings=False)
+    families, samples = [], {}
+    for line in session.metrics.to_prometheus().splitlines():
+        if line.startswith('# TYPE '):
+            families.append(line.split()[2])
+            continue
+        name = line.split('{')[0]
+        family = name.removesuffix('_bucket').removesuffix('_sum').removesuffix('_count') if families[-1] == 'exati_request_seconds' else name
+        assert family == families[-1]
+        samples.setdefault(family, set()).add(line.split('command="')[1].split('"')[0])
+    assert len(families) == len(set(families)) == 6
+    assert samples['exati_request_errors_total'] == {'ConsultarEquipes'}
+    assert all(commands == {'ConsultarAtendimentoPorPontoServico', 'ConsultarEquipes', 'Login'} for family, commands in samples.items() if family != 'exati_request_errors_total')
+
+
+def test_fake_exati_server(monkeypatch):
+    '''
+    Routers work over HTTP against FakeExati, including a re-login after tokens expire.
+    '''
+    with FakeExati(size=50) as server:
+        monkeypatch.setitem(os.environ, 'EXATI_URL', server.url)
+        with ExatiSession() as session:
+            assert 'Bairro' in ConsultarAtributos(session=session).name_to_records()
+            server.expire_tokens()
+            assert AtendimentoPorPontoServico(session=session).get_status_motivo_date(2)[0] == 'Atendido'
+            assert server.logins == 2
+
+
+def test_cassette_record_replay(monkeypatch, tmp_path):
+    '''
+    Responses recorded against FakeExati are replayed without network.
+    '''
+    path = str(tmp_path / 'cassette.sqlite')
+    with FakeExati(size=20) as server:
+        monkeypatch.setitem(os.environ, 'EXATI_URL', server.url)
+        with ExatiSession(cassette=Cassette(path, mode='record')) as session:
+            recorded = ConsultarAtributos(session=session).export()
+            streamed = list(IDsParqueServico(session=session).iter_records())
+    monkeypatch.setitem(os.environ, 'EXATI_URL', 'http://127.0.0.1:9/')
+    with ExatiSession(cassette=Cassette(path)) as session:
+        assert ConsultarAtributos(session=session).export() == recorded
+        assert list(IDsParqueServico(session=session).iter_records()) == streamed
+        assert session.metrics.snapshot()['ConsultarAtributos']['calls'] == 1
+
+
+def test_single_flight_coalesces_reads():
+    '''
+    Identical concurrent reads share one request, writes are never coalesced.
+    '''
+    def answer(payload: dict) -> dict:
+        return atendimento(payload) if payload['CMD_COMMAND'].startswith('Consultar') else envelope()
+
+    session = FakeSession(answer, delay=0.05, single_flight=SingleFlight())
+    read = {'CMD_COMMAND': 'ConsultarAtendimentoPorPontoServico', 'CMD_ID_PONTO_SERVICO': 1}
+    write = {'CMD_COMMAND': 'SalvarSolicitacaoPontoServico', 'CMD_ID_PONTO_SERVICO': 1}
+    responses = [response for _, response in map_concurrently(session.ex_post, [dict(read) for _ in range(8)])]
+    assert session.calls == 1
+    assert all(response is responses[0] for response in responses)
+    list(map_concurrently(session.ex_post, [dict(write) for _ in range(4)]))
+    assert session.calls == 1 + 4
+
+
+def test_rate_limiter_shared_and_adaptive(tmp_path):
+    '''
+    The bucket is shared through its file, honours costs and slows down on errors.
+    '''
+    path = str(tmp_path / 'bucket.sqlite')
+    limiter = RateLimiter(rate=50, burst=5, costs={'ConsultarPontosServicos': 5}, path=path)
+    other = RateLimiter(rate=50, burst=5, path=path)
+    start = monotonic()
+    limiter.acquire('ConsultarPontosServicos')
+    other.acquire()
+    assert monotonic() - start >= 0.015
+    for _ in range(5):
+        limiter.feedback(False)
+    assert limiter.rate < 50
+    assert other.rate == limiter.rate
+
+    with pytest.raises(ValueError):
+        RateLimiter(burst=2, costs={'ConsultarPontosServicos': 5})
+    slow = RateLimiter(rate=1, burst=1)
+    slow.acquire()
+    start = monotonic()
+    with deadline(0.1), pytest.raises(requests.exceptions.Timeout):
+        slow.acquire()
+    assert monotonic() - start < 0.1
+
+    session = FakeSession(lambda payload: envelope(['Servidor ocupado']), retry=RetryPolicy(max_attempts=3, base_delay=0),
+                          rate_limiter=RateLimiter(rate=100))
+    session.ex_post({'CMD_COMMAND': 'ConsultarAtributos'}, warnings=False)
+    assert session.rate_limiter.rate < 100
+
+
+def test_timeouts_and_deadline(monkeypatch):
+    '''
+    Attempts get per-command timeouts and a deadline stops retries of every thread of the block.
+    '''
+    timeouts = []
+    session = FakeSession(lambda payload: envelope(), timeouts={'ConsultarAtendimentoPorPontoServico': 5})
+    post = session.post
+    monkeypatch.setattr(session, 'post', lambda url=None, data=None, **kwargs: timeouts.append(kwargs['timeout']) or post(url, data))
+    session.ex_post({'CMD_COMMAND': 'ConsultarAtendimentoPorPontoServico', 'CMD_ID_PONTO_SERVICO': 1}, warnings=False)
+    session.ex_post({'CMD_COMMAND': 'ConsultarAtributos'}, warnings=False)
+    assert timeouts == [5, session.default_timeout]
+
+    busy = FakeSession(lambda payload: envelope(['Servidor ocupado']), delay=0.05,
+                       retry=RetryPolicy(max_attempts=100, base_delay=0.05, max_delay=0.05))
+    start = monotonic()
+    with deadline(0.3):
+        results = list(map_concurrently(busy.ex_post, [{'CMD_COMMAND': 'ConsultarAtributos', 'CMD_ID': n} for n in range(4)]))
+    assert monotonic() - start < 1
+    assert all(isinstance(result, requests.exceptions.Timeout) or result['RAIZ']['MESSAGES']['ERRORS'] for _, result in results)
+    assert busy.calls < 4 * 10
+
+
+def test_hedging_first_answer_wins():
+    '''
+    A slow read is duplicated after the threshold, writes never are.
+    '''
+    def answer(_payload: dict) -> dict:
+        if first.is_set():
+            return envelope(ANSWER='fast')
+        first.set()
+        sleep(0.5)
+        return envelope(ANSWER='slow')
+
+    first = threading.Event()
+    session = FakeSession(answer, hedging=Hedging(min_samples=0, min_delay=0.02))
+    start = monotonic()
+    assert session.ex_post({'CMD_COMMAND': 'ConsultarAtributos'}, warnings=False)['RAIZ']['ANSWER'] == 'fast'
+    assert monotonic() - start < 0.4
+    assert session.hedging.hedges == 1
+
+    first.clear()
+    assert session.ex_post({'CMD_COMMAND': 'SalvarAtributosPontosServico'}, warnings=False)['RAIZ']['ANSWER'] == 'slow'
+    assert session.hedging.hedges == 1
+    other = FakeSession(answer, hedging=session.hedging)
+    session.close()
+    assert other.ex_post({'CMD_COMMAND': 'ConsultarAtributos'}, warnings=False)['RAIZ']['ANSWER'] == 'fast'
+    other.hedging.close()
+    with pytest.raises(RuntimeError):
+        other.ex_post({'CMD_COMMAND': 'ConsultarAtributos'}, warnings=False)
+
+
+def test_session_pool_shares_token_and_connections(monkeypatch):
+    '''
+    Pooled sessions log in once, reuse size connections, keep Accept-Encoding and re-login once after tokens expire.
+    '''
+    with FakeExati(size=20, latency=0.005) as server:
+        monkeypatch.setitem(os.environ, 'EXATI_URL', server.url)
+
+        def work(ps: int) -> str:
+            with pool.session() as session:
+                assert 'gzip' in session.headers['Accept-Encoding']
+                return AtendimentoPorPontoServico(session=session).get_status_motivo_date(ps)[0]
+
+        with ExatiSessionPool(size=4) as pool:
+            assert all(result == 'Atendido' for _, result in map_concurrently(work, [2] * 40, max_workers=8))
+            server.expire_tokens()
+            assert all(result == 'Atendido' for _, result in map_concurrently(work, [2] * 40, max_workers=8))
+            with pool.session() as session:
+                async_session = AsyncExatiSession(session=session)
+                assert async_session.session.get_adapter(server.url) is pool.adapter
+                pools = len(pool.adapter.poolmanager.pools)
+                async_session.close()
+                assert pools and len(pool.adapter.poolmanager.pools) == pools
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                assert (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60) in pool.adapter.poolmanager.connection_pool_kw['socket_options']
+        assert server.logins == 2
+        assert server.connections <= 4
+
+
+def test_stream_follows_ex_post_rules(monkeypatch):
+    '''
+    Streams log in again, retry before the first record, feed metrics and raise ExatiError with the ERRORS.
+    '''
+    with FakeExati(size=20, error_rate=0.3, seed=1) as server:
+        monkeypatch.setitem(os.environ, 'EXATI_URL', server.url)
+        with ExatiSession(retry=RetryPolicy(max_attempts=10, base_delay=0)) as session:
+            server.expire_tokens()
+            for _ in range(5):
+                assert len(list(IDsParqueServico(session=session).iter_records(fields=('ID_PONTO_SERVICO',)))) == 20
+            assert server.logins == 2
+            metrics = session.metrics.snapshot()['ConsultarPontosServicos']
+            assert metrics['calls'] == 5 and metrics['attempts'] > 5 and metrics['bytes'] > 0
+            with pytest.raises(ExatiError, match='não encontrado'):
+                list(session.ex_post_stream({'CMD_COMMAND': 'ConsultarNada', 'parser': 'json'}, 'NADA', warnings=False))